@@ -6,43 +6,159 @@ system process them. You need to
 3. Adapt the get_file_list function for your use case
 4. Provide a process.sh bash script that takes source endpoint file name as argument. You will need
    to know where the file is located based on your endpoint configuration.
+One leader can run several projects, see --gdc-project-id.
 Good luck!
 """
 
 import os
 import sys
-import drmaa
 from multiprocessing.pool import Pool
 from argparse import ArgumentParser
-from helpers import GDCIterator
+from helpers import GDCIterator, CaseFileSet, FileRecord, aggregate, read_regions, slice_record
 import pickle
 import traceback
 import time
+import re
+import json
+import copy
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 #-----------------------------------------------------------------------------
-# Resources for your job in qsub format
-PBS_RESOURCES = '-l nodes=1:ppn=2,mem=12gb,walltime=72:01:00'
-# Resources for your job in sbatch format
-SLURM_RESOURCES = '--nodes=1 --cpus-per-task=2 --mem=12000 --time=72:01:00'
+# Resources for your job. The qsub and sbatch options are built from these
+JOB_CPUS = 2
+JOB_MEM_GB = 12
+JOB_WALLTIME_MINUTES = 72 * 60 + 1
+# Jobs killed at their memory or walltime limit are resubmitted with more, up to
+MAX_JOB_MEM_GB = 96
+MAX_JOB_WALLTIME_MINUTES = 14 * 24 * 60
+# Environment passed on to jobs (see download-and-process.sh)
+JOB_ENVIRONMENT = ['GDC_STAGING_DIR', 'GDC_COPY_BACK', 'GDC_ENDPOINT', 'GDC_CACHE_DIR', 'GDC_CACHE_QUOTA_GB',
+                   'GDC_POST_DOWNLOAD', 'GDC_REGIONS']
+# With GDC_REGIONS set to a BED file (or e.g. chr7:55019017-55211628,chr12) only those
+# regions of each BAM are downloaded, through the GDC slicing endpoint
+REGIONS = read_regions(os.environ['GDC_REGIONS']) if os.environ.get('GDC_REGIONS') else None
+#-----------------------------------------------------------------------------
+
+#-----------------------------------------------------------------------------
+"""
+What's in the output directories, from one os.scandir of each the first time it
+is asked about, rather than a stat per file. On a network filesystem the
+listing comes back in a few round trips however many BAMs there are. Listings
+aren't refreshed, so use a new probe for a new look.
+"""
+class OutputProbe:
+  def __init__(self):
+    self.listings = {}
+    self.lock = threading.Lock()
+
+  def listing(self, directory):
+    with self.lock:
+      if directory not in self.listings:
+        entries = {}
+        try:
+          with os.scandir(directory) as it:
+            for entry in it:
+              try:
+                st = entry.stat()
+              except FileNotFoundError:
+                continue
+              entries[entry.name] = (st.st_size, st.st_mtime)
+        except FileNotFoundError:
+          pass
+        self.listings[directory] = entries
+      return self.listings[directory]
+
+  '''
+  (size, mtime) of a path, or None if it doesn't exist.
+  '''
+  def stat(self, path):
+    (directory, name) = os.path.split(path)
+    return self.listing(directory or '.').get(name)
+
+
+def stat_path(path):
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return (st.st_size, st.st_mtime)
+
+
+"""
+Like filter(), but the predicate runs on a thread pool for up to `ahead` items
+at once. Items are still yielded in order, each as soon as it and those before
+it are decided, so a slow source keeps flowing through.
+"""
+def threaded_filter(predicate, iterable, threads=16, ahead=256):
+  with ThreadPoolExecutor(threads) as executor:
+    pending = deque()
+    for item in iterable:
+      pending.append((item, executor.submit(predicate, item)))
+      while pending and (pending[0][1].done() or len(pending) >= ahead):
+        (item, future) = pending.popleft()
+        if future.result():
+          yield item
+    for (item, future) in pending:
+      if future.result():
+        yield item
+
+"""
+Round robin over several iterables, one item from each in turn until all are
+exhausted. This is how projects share a leader: their cases are queued for the
+pool alternately, so none waits for another to finish.
+"""
+def interleave(*iterables):
+  iterators = deque(iter(i) for i in iterables)
+  while iterators:
+    it = iterators.popleft()
+    try:
+      item = next(it)
+    except StopIteration:
+      continue
+    iterators.append(it)
+    yield item
 #-----------------------------------------------------------------------------
 
 #-----------------------------------------------------------------------------
 """
 The file might have already been downloaded and processed, in which
-return False and that will be skipped
+return False and that will be skipped. Pass an OutputProbe to check a whole
+cohort against one listing of the output directory.
 """
-def are_files_needed(case_file_set):
+def are_files_needed(case_file_set, probe=None):
+  if REGIONS:
+    # Slices have no size or md5sum from GDC, only the record of what was sliced
+    for f in case_file_set.file_names:
+      if slice_record(f, REGIONS) is None:
+        print(f'no complete slice: {f}')
+        return True
+    return False
 
-  for (f, s) in zip(case_file_set.file_names, case_file_set.md5s):
+  stat = probe.stat if probe else stat_path
+
+  files = list(zip(case_file_set.file_names, case_file_set.md5s, case_file_set.sizes))
+  for (index_name, index) in zip(case_file_set.index_names, case_file_set.index_files):
+    if index:
+      files.append((index_name, index[1], index[2]))
+
+  for (f, s, size) in files:
     # If the output file doesn't exist we need to download it
-    if not os.path.exists(f):
+    st = stat(f)
+    if st is None:
       print(f'no output file: {f}')
       return True
 
+    # A partial download
+    if st[0] != size:
+      print(f'Size mismatch for {f}. expected: {size}  got: {st[0]}')
+      return True
+
     sum_file = os.path.splitext(f)[0] + '.md5'
 
     # If the md5sum file doesn't exist, download is presumably incomplete
-    if not os.path.exists(sum_file):
+    if stat(sum_file) is None:
       print(f'no checksum file: {sum_file}')
       return True
 
@@ -95,7 +211,13 @@ file_filters = {
     }
   ]
 }
-file_fields = 'file_id,file_name,md5sum,file_size,cases.samples.portions.analytes.aliquots.submitter_id'
+# Only these fields are fetched. Each file hit is flattened into a FileRecord.
+file_fields = FileRecord.FIELDS
+case_fields = ['case_id', 'submitter_id']
+
+# Largest id lists put in a single GDC filter clause, to stay under the request size limit
+MAX_IN_VALUES = 500
+MAX_EXCLUDE_VALUES = 2000
 #-----------------------------------------------------------------------------
 
 
@@ -106,12 +228,14 @@ Command line argument parser
 def build_parser():
   parser = ArgumentParser()
   parser.add_argument('--output-dir',
-                      help='The directory where files will be downloaded to',
+                      help='The directory where files will be downloaded to. {cancer} or {project} in it, and in '
+                           'the other paths, are replaced for each project, and must be used when there are several',
                       dest='output_dir',
                       required=True)
   parser.add_argument('--num-jobs',
                       dest='num_jobs',
-                      help='Number of concurrent download jobs (each job downloads all files for a case in parallel.',
+                      help='Number of concurrent download jobs, across all projects (each job downloads all files '
+                           'for a case in parallel.',
                       type=int,
                       default=1,
                       required=False)
@@ -123,20 +247,22 @@ def build_parser():
                       required=False)
   parser.add_argument('--stop-after',
                       dest='stop_after',
-                      help='Stop after submitting this many jobs (useful when testing).',
+                      help='Stop after submitting this many jobs, across all projects (useful when testing).',
                       type=int,
                       default=sys.maxsize,
                       required=False)
   parser.add_argument('--save-query-file',
                       dest='save_query_file',
                       help='If this file exists, unpickle it instead of redoing the query. ' + \
-                           'If it does not exist save the query into this file.',
+                           'If it does not exist save the query into this file. ' + \
+                           'Must contain {cancer} or {project} when there are several projects.',
                       type=str,
                       default=None,
                       required=False)
   parser.add_argument('--gdc-project-id',
                       dest='gdc_project_id',
-                      help='The GDC project id, e.g. TCGA-SKCM, TCGA-LUAD, etc',
+                      help='The GDC project id, e.g. TCGA-SKCM, TCGA-LUAD, etc. A comma separated list runs the '
+                           'projects together, sharing the job pool and taking cases from each in turn',
                       type=str,
                       default=None,
                       required=True)
@@ -152,6 +278,12 @@ def build_parser():
                       default=False,
                       action='store_true',
                       required=False)
+  parser.add_argument('--plan',
+                      dest='plan',
+                      help='Estimate the files, bytes and jobs left from GDC totals, without listing files, then exit',
+                      default=False,
+                      action='store_true',
+                      required=False)
   parser.add_argument('--metadata-only',
                       dest='metadata_only',
                       help='Only downoad the metadata',
@@ -160,11 +292,14 @@ def build_parser():
                       required=False)
   parser.add_argument('--cancer',
                       dest='cancer',
-                      help='The TCGA cancer name, e.g. COAD, SKCM, etc',
-                      required=True)
+                      help='The TCGA cancer name, e.g. COAD, SKCM, etc, or a comma separated list with one for each '
+                           'project. Defaults to the project id without the program, e.g. LUAD for TCGA-LUAD',
+                      default=None,
+                      required=False)
   parser.add_argument('--whitelist',
                       dest='whitelist',
-                      help='A file of case ids to process. If not specified, all cases are processed',
+                      help='A file of case ids to process. If not specified, all cases are processed. '
+                           'With several projects, one without its whitelist file is skipped',
                       default=None,
                       required=False)
   parser.add_argument('--logdir',
@@ -172,63 +307,184 @@ def build_parser():
                       help='Directory for job output files',
                       default=None,
                       required=False)
+  parser.add_argument('--max-attempts',
+                      dest='max_attempts',
+                      help='Times to run a case\'s job before giving up on it',
+                      type=int,
+                      default=3,
+                      required=False)
+  parser.add_argument('--retry-delay',
+                      dest='retry_delay',
+                      help='Seconds before resubmitting a failed job, doubled for each further attempt',
+                      type=int,
+                      default=600,
+                      required=False)
+  parser.add_argument('--failed-file',
+                      dest='failed_file',
+                      help='Cases that failed every attempt are appended to this file. '
+                           'Defaults to {cancer}-failed.txt in the log directory, and can be given as --whitelist to retry them',
+                      default=None,
+                      required=False)
+  parser.add_argument('--journal-file',
+                      dest='journal_file',
+                      help='Journal of submitted jobs. A restarted leader follows jobs still in flight and skips '
+                           'cases that are done. Defaults to {cancer}-jobs.journal in the log directory',
+                      default=None,
+                      required=False)
+  parser.add_argument('--redo-done',
+                      dest='redo_done',
+                      help='Reconsider cases the journal records as done',
+                      action='store_true',
+                      default=False,
+                      required=False)
 
   return parser
 #-----------------------------------------------------------------------------
 
 
 #-----------------------------------------------------------------------------
-'''
-A simple container for files associated with an individual patient
-'''
-class CaseFileSet:
-  def __init__(self, output_dir, case_id):
-    self.file_ids      = []
-    self.file_names    = []
-    self.md5s          = []
-    self.sizes         = []
-    self.submitter_ids = []
-    self.case_id       = case_id
-    self.output_dir    = output_dir
-
-  def add(self, file_id, file_name, md5, size, submitter_id):
-    self.md5s.append(md5)
-    self.file_ids.append(file_id)
-    self.file_names.append(os.path.join(self.output_dir, file_name))
-    self.sizes.append(size)
-    self.submitter_ids.append(submitter_id)
-#-----------------------------------------------------------------------------
+"""
+case_filters for one project. Each query gets its own copy, so the queries of
+several projects can be paged through side by side.
+"""
+def project_case_filter(project_id):
+  project = copy.deepcopy(case_filters)
+  project['content']['value'] = project_id
+  return project
 
 
-#-----------------------------------------------------------------------------
 """
-During testing, just return a single file, then scale up
+The case queries to run. A whitelist becomes 'in' clauses, chunked so each
+request stays small, and cases we already have are excluded on the server
+rather than paged through and skipped.
 """
-def get_file_list(output_dir):
-  print('Starting file query')
+def case_queries(project_id, whitelist=None, exclude=()):
+  project = project_case_filter(project_id)
+  if whitelist:
+    ids = sorted(set(whitelist) - set(exclude))
+    for i in range(0, len(ids), MAX_IN_VALUES):
+      yield {'op': 'and', 'content': [
+        project,
+        {'op': 'in', 'content': {'field': 'case_id', 'value': ids[i:i + MAX_IN_VALUES]}}
+      ]}
+  elif exclude and len(exclude) <= MAX_EXCLUDE_VALUES:
+    yield {'op': 'and', 'content': [
+      project,
+      {'op': 'exclude', 'content': {'field': 'case_id', 'value': sorted(exclude)}}
+    ]}
+  else:
+    yield project
+
+"""
+Yields a CaseFileSet for each case as soon as its files have been listed, so
+jobs can be submitted while the rest of the query is still running. Cases in
+known_cases are yielded first without asking GDC for them again.
+"""
+def iter_file_list(output_dir, project_id, known_cases=None, whitelist=None):
+  print(f'Starting file query for {project_id}')
+
+  known_cases = known_cases or {}
+  for case_id, cfs in known_cases.items():
+    if not whitelist or case_id in whitelist:
+      yield cfs
+
+  case_file_filters = copy.deepcopy(file_filters)
+  for case in (c for q in case_queries(project_id, whitelist, known_cases.keys())
+               for c in GDCIterator('cases', q, fields=case_fields)):
+    # Only when there were too many to exclude in the query
+    if case['case_id'] in known_cases:
+      continue
 
-  files = []
-  for case in GDCIterator('cases', case_filters):
     this_case = case['submitter_id']
-    file_filters['content'][0]['content']['value'] = this_case
+    case_file_filters['content'][0]['content']['value'] = this_case
 
     cfs = CaseFileSet(output_dir, case['case_id'])
-    for fl in GDCIterator('files', file_filters, fields=file_fields):
-      filename = fl['file_name']
-      file_id  = fl['file_id']
-      md5      = fl['md5sum']
-      size     = fl['file_size']
-      submitter_id = fl['cases'][0]['samples'][0]['portions'][0]['analytes'][0]['aliquots'][0]['submitter_id']
-      cfs.add(file_id, filename, md5, size, submitter_id)
-      print(f'found {filename}')
-
-    files.append(cfs)
-
-  return files
+    for fl in GDCIterator('files', case_file_filters, fields=file_fields, record=FileRecord.from_hit):
+      # A file made from several aliquots lists them all, joined with +. The
+      # index (e.g. the .bai for a BAM) is downloaded alongside it.
+      cfs.add(fl.file_id, fl.file_name, fl.md5sum, fl.file_size, '+'.join(fl.aliquots), fl.index)
+      print(f'found {fl.file_name}')
+
+    yield cfs
+
+"""
+During testing, just return a single file, then scale up
+"""
+def get_file_list(output_dir, project_id):
+  return list(iter_file_list(output_dir, project_id))
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+"""
+The query cache. A completed query is saved as a pickled list of CaseFileSets.
+While the query runs, each case is appended to a .partial file as it arrives,
+so a leader that dies part way through only re-lists the cases it hadn't seen.
+A whitelisted query never completes the cache, its cases are only added to the
+.partial file for the next full run to reuse.
+"""
+def read_partial_query(partial_file):
+  cases = {}
+  if not os.path.exists(partial_file):
+    return cases
+
+  with open(partial_file, 'rb') as f:
+    while True:
+      try:
+        cfs = pickle.load(f)
+      except EOFError:
+        break
+      except (pickle.UnpicklingError, AttributeError, ValueError) as ex:
+        # A truncated last record from a crash
+        print(f'{partial_file}: stopped reading at damaged record: {ex}')
+        break
+      cases[cfs.case_id] = cfs
+  return cases
+
+def cached_file_list(output_dir, project_id, save_query_file, whitelist=None):
+  if save_query_file is None:
+    yield from iter_file_list(output_dir, project_id, whitelist=whitelist)
+    return
+
+  if os.path.exists(save_query_file):
+    with open(save_query_file, 'rb') as f:
+      yield from pickle.load(f)
+    return
+
+  partial_file = save_query_file + '.partial'
+  known_cases = read_partial_query(partial_file)
+  if known_cases:
+    print(f'Reusing {len(known_cases)} cases from {partial_file}')
+
+  case_files = []
+  with open(partial_file, 'ab') as f:
+    for cfs in iter_file_list(output_dir, project_id, known_cases, whitelist):
+      if cfs.case_id not in known_cases:
+        pickle.dump(cfs, f)
+        f.flush()
+      case_files.append(cfs)
+      yield cfs
+
+  if whitelist:
+    return
+
+  tmp = save_query_file + '.tmp'
+  with open(tmp, 'wb') as f:
+    pickle.dump(case_files, f)
+  os.replace(tmp, save_query_file)
+  os.remove(partial_file)
 #-----------------------------------------------------------------------------
 
 
 #-----------------------------------------------------------------------------
+'''
+The --index-files argument for single_file_download.py: file_id:md5:size:extension
+for each file's index, or none for a file without one.
+'''
+def index_arg(case_file_set):
+  return ','.join(':'.join(str(v) for v in index) if index else 'none' for index in case_file_set.index_files)
+
+
 '''
 A class that runs a synchronous bash command
 '''
@@ -252,7 +508,8 @@ class BashJob:
       ','.join(md5sums),
       ','.join([str(size) for size in sizes]),
       ','.join(submitter_ids),
-      self.cancer
+      self.cancer,
+      index_arg(self.cfs)
     ])
     rc = os.system(cmd)
     if rc != 0:
@@ -264,24 +521,301 @@ class BashJob:
 
 
 #-----------------------------------------------------------------------------
+"""
+The leader's job journal: one JSON record per line, appended as jobs change
+state, so a restarted leader knows what it had submitted. A case's last record
+is its state:
+- submitted  job_id is in the batch system, with the attempt and resources
+- done       its job succeeded
+- failed     every attempt failed
+Records are single writes to a file opened for appending, so workers can add
+them concurrently.
+"""
+def journal(journal_file, case_id, state, **fields):
+  if not journal_file:
+    return
+  record = dict(case_id=case_id, state=state, time=time.strftime('%Y-%m-%dT%H:%M:%S'), **fields)
+  with open(journal_file, 'a') as f:
+    f.write(json.dumps(record) + '\n')
+
+
+def read_journal(journal_file):
+  states = {}
+  if not journal_file or not os.path.exists(journal_file):
+    return states
+  with open(journal_file) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # A line cut short when the leader died
+        continue
+      states[record['case_id']] = record
+  return states
+
+
+# DRMAA job states (drmaa.JobState names) that mean a job is still in the batch system
+ACTIVE_JOB_STATES = [
+  'QUEUED_ACTIVE',
+  'SYSTEM_ON_HOLD',
+  'USER_ON_HOLD',
+  'USER_SYSTEM_ON_HOLD',
+  'RUNNING',
+  'SYSTEM_SUSPENDED',
+  'USER_SUSPENDED',
+  'USER_SYSTEM_SUSPENDED',
+]
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+"""
+The resources a job asks the batch system for.
+"""
+class JobResources:
+  def __init__(self, cpus=JOB_CPUS, mem_gb=JOB_MEM_GB, walltime_minutes=JOB_WALLTIME_MINUTES):
+    self.cpus = cpus
+    self.mem_gb = mem_gb
+    self.walltime_minutes = walltime_minutes
+
+  def _walltime(self):
+    (hours, minutes) = divmod(self.walltime_minutes, 60)
+    return f'{hours}:{minutes:02d}:00'
+
+  def pbs(self):
+    return f'-l nodes=1:ppn={self.cpus},mem={self.mem_gb}gb,walltime={self._walltime()}'
+
+  def slurm(self):
+    return f'--nodes=1 --cpus-per-task={self.cpus} --mem={self.mem_gb * 1000} --time={self._walltime()}'
+
+  '''
+  More of the resource a job ran out of, or None if it already has the most allowed.
+  '''
+  def escalate(self, reason):
+    mem_gb = self.mem_gb
+    walltime_minutes = self.walltime_minutes
+    if reason == 'memory':
+      mem_gb = min(MAX_JOB_MEM_GB, mem_gb * 2)
+    elif reason == 'walltime':
+      walltime_minutes = min(MAX_JOB_WALLTIME_MINUTES, walltime_minutes * 3 // 2)
+    if (mem_gb, walltime_minutes) == (self.mem_gb, self.walltime_minutes):
+      return None
+    return JobResources(self.cpus, mem_gb, walltime_minutes)
+
+  def __str__(self):
+    return f'{self.cpus} cpus, {self.mem_gb}GB, {self._walltime()}'
+
+
+USAGE_NUMBER = re.compile(r'([0-9.]+)\s*([kmgt]?)i?b?$')
+USAGE_UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+# The unit of a memory number without a suffix, by batch system: kB for PBS mem
+# and maxrss, bytes for SGE maxvmem
+PLAIN_MEMORY_UNITS = {'mem': 1024, 'maxrss': 1024, 'ru_maxrss': 1024, 'maxvmem': 1}
+
+"""
+Wall time in seconds and memory in bytes from DRMAA resource usage. Each batch
+system names and formats these differently, e.g. PBS gives
+resources_used.walltime=72:01:05 and resources_used.mem=123456kb, SGE gives
+ru_wallclock in seconds and maxvmem in bytes. SGE's mem is memory integrated
+over time (GB seconds), not a size, so it is ignored.
+"""
+def parse_usage(resource_usage):
+  resource_usage = {k.lower().rsplit('.', 1)[-1]: str(v).strip().lower() for (k, v) in (resource_usage or {}).items()}
+  sge = 'maxvmem' in resource_usage or 'ru_wallclock' in resource_usage
+  usage = {}
+  for (k, v) in resource_usage.items():
+    try:
+      if k in ('walltime', 'wallclock', 'ru_wallclock'):
+        seconds = 0.0
+        for part in v.split(':'):
+          seconds = seconds * 60 + float(part)
+        usage['walltime'] = seconds
+      elif k in PLAIN_MEMORY_UNITS and not (sge and k == 'mem'):
+        m = USAGE_NUMBER.match(v)
+        if m:
+          unit = USAGE_UNITS[m.group(2)] if m.group(2) else PLAIN_MEMORY_UNITS[k]
+          usage['mem'] = max(usage.get('mem', 0), float(m.group(1)) * unit)
+    except ValueError:
+      pass
+  return usage
+
+
+"""
+Why a finished job failed: None if it succeeded, 'walltime' or 'memory' if it
+hit that limit and 'failed' otherwise. Limits are judged from the resource usage
+where the batch system reports it, otherwise a SIGKILL (exit status 137, or 265
+on PBS) is taken to be the out of memory killer.
+"""
+def job_failure(info, resources):
+  if info.hasExited and info.exitStatus == 0 and not info.wasAborted:
+    return None
+
+  usage = parse_usage(info.resourceUsage)
+  if usage.get('walltime', 0) >= 0.98 * resources.walltime_minutes * 60:
+    return 'walltime'
+  if usage.get('mem', 0) >= 0.95 * resources.mem_gb * 1024 ** 3:
+    return 'memory'
+  if (info.hasSignal and info.terminatedSignal in ('SIGKILL', '9')) or \
+     (info.hasExited and info.exitStatus in (137, 265)):
+    return 'memory'
+  return 'failed'
+
+
 """
  This class builds and manages a batch job
 """
 class Job:
-  def __init__(self, case_file_set, cancer, logdir):
+  # A failed submission is retried this many times, after a delay that doubles
+  # from submit_delay up to max_submit_delay seconds
+  submit_attempts = 10
+  submit_delay = 120
+  max_submit_delay = 3600
+  # Seconds between status checks on a job reattached after a leader restart
+  status_poll = 60
+
+  def __init__(self, case_file_set, cancer, logdir, max_attempts=3, retry_delay=600, failed_file=None,
+               journal_file=None, resume=None):
     self.cfs = case_file_set
     self.cancer = cancer
     self.logdir = logdir
+    self.max_attempts = max_attempts
+    self.retry_delay = retry_delay
+    self.failed_file = failed_file
+    self.journal_file = journal_file
+    self.resume = resume
     self.session = None
+    self.job_id = None
+    self.attempt = 0
+
+  """
+  Run the case's job, resubmitting it up to max_attempts times if it fails, with
+  a delay that doubles from retry_delay. A job killed at its memory or walltime
+  limit is resubmitted with more. Returns False if every attempt failed, after
+  recording the case in failed_file.
 
+  With resume, the case's last 'submitted' journal record, the job already in
+  the batch system is followed instead of submitting another.
+  """
   def __call__(self, *args, **kwargs):
-    while not self._submitted():
-      print('Job submit failed, retrying in 120 seconds')
-      time.sleep(120)
+    resources = JobResources()
+    reason = None
+    if self.resume:
+      self.attempt = self.resume['attempt']
+      resources = JobResources(self.resume['cpus'], self.resume['mem_gb'], self.resume['walltime_minutes'])
+      reason = self._reattach(self.resume['job_id'], resources)
+      if reason is None:
+        self._journal('done')
+        return True
+      print(f'Job {self.job_id} for case {self.cfs.case_id} failed ({reason}), attempt {self.attempt} of {self.max_attempts}')
+
+    while self.attempt < self.max_attempts:
+      if reason:
+        resources = self._backoff(reason, resources)
+      self.attempt += 1
+      if not self._submit(resources):
+        reason = 'submit failed'
+        break
+
+      if not self.session:
+        self._journal('done')
+        return True
+
+      info = self._wait()
+      # If the job can't be waited on it is assumed to have completed
+      reason = job_failure(info, resources) if info else None
+      if reason is None:
+        self._journal('done')
+        return True
+
+      print(f'Job {self.job_id} for case {self.cfs.case_id} failed ({reason}), attempt {self.attempt} of {self.max_attempts}')
+
+    self._record_failure(reason, self.attempt)
+    return False
+
+  def _backoff(self, reason, resources):
+    if reason in ('memory', 'walltime'):
+      escalated = resources.escalate(reason)
+      if escalated:
+        resources = escalated
+        print(f'Resubmitting with {resources}')
+    delay = self.retry_delay * 2 ** (self.attempt - 1)
+    print(f'Resubmitting in {delay} seconds')
+    time.sleep(delay)
+    return resources
+
+  def _journal(self, state, **fields):
+    journal(self.journal_file, self.cfs.case_id, state, job_id=self.job_id, attempt=self.attempt, **fields)
 
-    if not self.session:
-      return
+  def _record_failure(self, reason, attempts):
+    print(f'Giving up on case {self.cfs.case_id}: {reason} after {attempts} attempts')
+    self._journal('failed', reason=reason)
+    if self.failed_file:
+      # One write per line, so lines from several workers don't interleave
+      with open(self.failed_file, 'a') as f:
+        f.write(f'{self.cfs.case_id}\t{reason}\t{attempts}\t{self.job_id}\n')
 
+  """
+  Follow a job submitted before the leader restarted until it leaves the batch
+  system, and say why it failed as job_failure does. Its exit status is used if
+  the batch system still has it, otherwise its final state. A job that has
+  already been forgotten ended while the leader was down, so its files decide.
+  """
+  def _reattach(self, job_id, resources):
+    import drmaa
+
+    active = [getattr(drmaa.JobState, state) for state in ACTIVE_JOB_STATES]
+    self.job_id = job_id
+    s = drmaa.Session()
+    s.initialize()
+    self.session = s
+    status = None
+    while True:
+      try:
+        status = s.jobStatus(job_id)
+      except drmaa.errors.InvalidJobException:
+        status = None
+      except drmaa.errors.InternalException as ex:
+        print(ex)
+        time.sleep(self.status_poll)
+        continue
+      if status not in active:
+        break
+      time.sleep(self.status_poll)
+    print(f'Reattached to job {job_id} for case {self.cfs.case_id}: {status or "no longer known"}')
+
+    info = None
+    if status is not None:
+      try:
+        info = s.wait(job_id, drmaa.Session.TIMEOUT_NO_WAIT)
+      except drmaa.errors.DrmaaException:
+        pass
+    self._exit_session()
+
+    if info is not None:
+      return job_failure(info, resources)
+    if status == drmaa.JobState.DONE:
+      return None
+    if status == drmaa.JobState.FAILED:
+      return 'failed'
+    return 'failed' if are_files_needed(self.cfs) else None
+
+  def _submit(self, resources):
+    delay = self.submit_delay
+    for _ in range(self.submit_attempts):
+      if self._submitted(resources):
+        if self.session:
+          self._journal('submitted', cpus=resources.cpus, mem_gb=resources.mem_gb,
+                        walltime_minutes=resources.walltime_minutes)
+        return True
+      print(f'Job submit failed, retrying in {delay} seconds')
+      time.sleep(delay)
+      delay = min(2 * delay, self.max_submit_delay)
+    return False
+
+  def _wait(self):
+    import drmaa
+
+    info = None
     finished = False
     while not finished:
       try:
@@ -290,6 +824,7 @@ class Job:
         print("""\
           id:                        %(jobId)s
           exited:                    %(hasExited)s
+          exit status:               %(exitStatus)s
           signaled:                  %(hasSignal)s
           with signal (id signaled): %(terminatedSignal)s
           dumped core:               %(hasCoreDump)s
@@ -298,7 +833,6 @@ class Job:
           %(resourceUsage)s
           """ % info._asdict())
         finished = True
-        self.session.exit()
       except drmaa.errors.NoActiveSessionException:
         finished = True
         print('No active session, giving up waiting')
@@ -313,7 +847,22 @@ class Job:
         traceback.print_stack()
         time.sleep(120)
 
-  def _submitted(self):
+    self._exit_session()
+    return info
+
+  def _exit_session(self):
+    import drmaa
+
+    # Each worker can only have one DRMAA session open at a time
+    try:
+      self.session.exit()
+    except drmaa.errors.NoActiveSessionException:
+      pass
+    self.session = None
+
+  def _submitted(self, resources):
+    import drmaa
+
     output_paths = self.cfs.file_names
     file_ids = self.cfs.file_ids
     md5sums = self.cfs.md5s
@@ -345,20 +894,201 @@ class Job:
         ','.join(md5sums),
         ','.join([str(size) for size in sizes]),
         ','.join(submitter_ids),
-        self.cancer
+        self.cancer,
+        index_arg(self.cfs)
       ]
+      env = {k: os.environ[k] for k in JOB_ENVIRONMENT if k in os.environ}
+      if env:
+        jt.jobEnvironment = env
       if is_slurm:
-        jt.nativeSpecification = SLURM_RESOURCES
+        jt.nativeSpecification = resources.slurm()
       else:
-        jt.nativeSpecification = PBS_RESOURCES
+        jt.nativeSpecification = resources.pbs()
       self.job_id = s.runJob(jt)
 
     except drmaa.errors.InternalException as ex:
       print(ex)
       traceback.print_stack()
+      self._exit_session()
       return False
 
     return True
+#-----------------------------------------------------------------------------
+"""
+The file and case filters for a whole project: file_filters with the
+cases.submitter_id clause replaced by the project, and case_filters for the
+project's cases with files matching the rest of file_filters.
+"""
+def project_filters(project_id):
+  files = copy.deepcopy(file_filters)
+  files['content'][0] = {'op': '=', 'content': {'field': 'cases.project.project_id', 'value': project_id}}
+  cases = {'op': 'and', 'content': [project_case_filter(project_id)]}
+  for clause in file_filters['content'][1:]:
+    cases['content'].append({'op': clause['op'],
+                             'content': {'field': 'files.' + clause['content']['field'],
+                                         'value': clause['content']['value']}})
+  return (files, cases)
+
+
+"""
+Estimate what a run has left to do from two GDC aggregation queries, rather
+than listing every case's files. GDC gives the number of files, their bytes and
+breakdown by data_format and experimental_strategy, and the number of cases.
+These are set against the verified downloads in one listing of the output
+directory and, if there is one, the job journal.
+"""
+def plan(project_id, output_dir, journal_file):
+  (files_filter, cases_filter) = project_filters(project_id)
+  (num_files, aggregations) = aggregate('files', files_filter, ['data_format', 'experimental_strategy', 'file_size'])
+  (num_cases, _) = aggregate('cases', cases_filter)
+  total_bytes = int(aggregations.get('file_size', {}).get('stats', {}).get('sum') or 0)
+  breakdown = {f: {b['key']: b['doc_count'] for b in aggregations.get(f, {}).get('buckets', [])}
+               for f in ('data_format', 'experimental_strategy')}
+
+  # Downloads of the queried formats with a checksum file beside them
+  extensions = {'.' + f.lower() for f in breakdown['data_format']}
+  listing = OutputProbe().listing(output_dir)
+  local_files = 0
+  local_bytes = 0
+  for (name, (size, _)) in listing.items():
+    (base, extension) = os.path.splitext(name)
+    if extension.lower() in extensions and base + '.md5' in listing:
+      local_files += 1
+      local_bytes += size
+
+  remaining_files = max(0, num_files - local_files)
+  states = [r['state'] for r in read_journal(journal_file).values()]
+  if states:
+    remaining_jobs = max(0, num_cases - states.count('done') - states.count('failed'))
+  elif num_files:
+    remaining_jobs = -(-num_cases * remaining_files // num_files)
+  else:
+    remaining_jobs = 0
+
+  estimate = {
+    'project_id': project_id,
+    'files': num_files,
+    'bytes': total_bytes,
+    'cases': num_cases,
+    'data_format': breakdown['data_format'],
+    'experimental_strategy': breakdown['experimental_strategy'],
+    'local_files': local_files,
+    'local_bytes': local_bytes,
+    'remaining_files': remaining_files,
+    'remaining_bytes': max(0, total_bytes - local_bytes),
+    'remaining_jobs': remaining_jobs,
+    'journal': {s: states.count(s) for s in set(states)}
+  }
+
+  TB = 1e12
+  kinds = ', '.join(f'{k} {v}' for f in ('data_format', 'experimental_strategy') for (k, v) in breakdown[f].items())
+  print(f'{project_id}: {num_files} files, {total_bytes / TB:.2f} TB in {num_cases} cases ({kinds})')
+  print(f'  downloaded {local_files} files, {local_bytes / TB:.2f} TB; '
+        f'remaining {remaining_files} files, {estimate["remaining_bytes"] / TB:.2f} TB in about {remaining_jobs} jobs')
+  if states:
+    print('  journal: ' + ', '.join(f'{v} {k}' for (k, v) in sorted(estimate['journal'].items())))
+  return estimate
+#-----------------------------------------------------------------------------
+
+
+#-----------------------------------------------------------------------------
+"""
+One GDC project in a run. The paths given on the command line may contain
+{cancer} or {project}, filled in for each project, so the projects of a run
+keep their own output directories, query caches, journals and failed files.
+"""
+class Project:
+  def __init__(self, project_id, cancer, options, logdir):
+    def fill(path):
+      return fill_path(path, project_id, cancer)
+
+    self.project_id = project_id
+    self.cancer = cancer
+    self.logdir = logdir
+    self.output_dir = fill(options.output_dir)
+    self.save_query_file = fill(options.save_query_file)
+    self.whitelist = read_whitelist(fill(options.whitelist))
+    self.redo_done = options.redo_done
+    self.failed_file = fill(options.failed_file) or os.path.join(logdir, f'{cancer}-failed.txt')
+    self.journal_file = fill(options.journal_file) or os.path.join(logdir, f'{cancer}-jobs.journal')
+    self.jobs = read_journal(self.journal_file)
+    self.in_flight = {c for (c, r) in self.jobs.items() if r['state'] == 'submitted'}
+    if self.jobs:
+      print(f'{self.journal_file}: {len(self.jobs)} cases, {len(self.in_flight)} with jobs still to follow')
+
+  '''
+  (project, CaseFileSet) for each of the project's cases, as they are listed.
+  Cases with jobs in flight are listed whatever the whitelist says, so they
+  are followed to the end.
+  '''
+  def case_files(self):
+    listed = self.whitelist | self.in_flight if self.whitelist else None
+    for cfs in cached_file_list(self.output_dir, self.project_id, self.save_query_file, listed):
+      if not listed or cfs.case_id in listed:
+        yield (self, cfs)
+
+  '''
+  The journal decides for cases the leader has seen before, so a restart
+  doesn't go back to the files. Failed cases are reconsidered when they are
+  whitelisted (e.g. the failed file given back as --whitelist), done cases
+  only with --redo-done.
+  '''
+  def needs_job(self, case_file_set, probe, run_anyway=False):
+    state = self.jobs.get(case_file_set.case_id, {}).get('state')
+    if state == 'submitted':
+      return True
+    if state == 'done' and not self.redo_done:
+      return False
+    if state == 'failed' and not self.whitelist:
+      return False
+    return run_anyway or are_files_needed(case_file_set, probe)
+
+  def job(self, case_file_set, max_attempts, retry_delay, resume=None):
+    return Job(case_file_set, self.cancer, self.logdir, max_attempts, retry_delay, self.failed_file,
+               self.journal_file, resume)
+
+
+def fill_path(path, project_id, cancer):
+  return path.format(cancer=cancer, project=project_id) if path else path
+
+
+# Options naming a path of a project's own
+PROJECT_PATH_OPTIONS = ['output_dir', 'save_query_file', 'whitelist', 'failed_file', 'journal_file']
+
+
+"""
+The projects named by --gdc-project-id, a comma separated list. Without
+--cancer, each project's cancer is its project id without the program, e.g.
+LUAD for TCGA-LUAD. A project whose whitelist doesn't exist is left out.
+"""
+def read_projects(parser, options, logdir):
+  project_ids = [p.strip() for p in options.gdc_project_id.split(',') if p.strip()]
+  if options.cancer:
+    cancers = [c.strip() for c in options.cancer.split(',')]
+    if len(cancers) != len(project_ids):
+      parser.error('--cancer needs one name for each project in --gdc-project-id')
+  else:
+    cancers = [p.split('-', 1)[-1] for p in project_ids]
+
+  if len(project_ids) > 1:
+    for option in PROJECT_PATH_OPTIONS:
+      value = getattr(options, option)
+      if value and '{cancer}' not in value and '{project}' not in value:
+        parser.error(f'--{option.replace("_", "-")} needs {{cancer}} or {{project}} in it when there are several projects')
+
+  projects = []
+  for (project_id, cancer) in zip(project_ids, cancers):
+    whitelist = fill_path(options.whitelist, project_id, cancer)
+    if whitelist and not os.path.exists(whitelist):
+      print(f'{project_id}: skipped, its whitelist {whitelist} does not exist')
+      continue
+    projects.append(Project(project_id, cancer, options, logdir))
+  if not projects:
+    parser.error('no projects to run')
+  return projects
+#-----------------------------------------------------------------------------
+
+
 #-----------------------------------------------------------------------------
 def read_whitelist(whitelist_file):
   if not whitelist_file:
@@ -367,10 +1097,12 @@ def read_whitelist(whitelist_file):
   with open(whitelist_file) as f:
     wl = f.readlines()
 
+  # Only the first column is used, so a failed cases file can be given here
   whitelist = set()
   for c in wl:
-    if len(c) != 0:
-      whitelist.add(c.strip())
+    c = c.split()
+    if c:
+      whitelist.add(c[0])
 
   return whitelist
 #-----------------------------------------------------------------------------
@@ -381,67 +1113,84 @@ def main(argv):
   num_jobs = options.num_jobs
   stop_after = options.stop_after
   start_after = options.start_after
-  output_dir = options.output_dir
-  os.makedirs(output_dir, mode=0o770, exist_ok=True)
-  save_query_file = options.save_query_file
   dry_run = options.dry_run
   run_anyway = options.run_anyway
-  gdc_project_id = options.gdc_project_id
-  cancer = options.cancer
-  whitelist = read_whitelist(options.whitelist)
   metadata_only = options.metadata_only
   logdir = options.logdir
   if not logdir:
     logdir = os.getcwd()
+  max_attempts = options.max_attempts
+  retry_delay = options.retry_delay
+  projects = read_projects(parser, options, logdir)
 
-  case_filters['content']['value'] = gdc_project_id
+  if options.plan:
+    for project in projects:
+      plan(project.project_id, project.output_dir, project.journal_file)
+    quit()
 
-  # Get the file list and filter for the ones we want to process
-  if save_query_file is not None and os.path.exists(save_query_file):
-    with open(save_query_file, 'rb') as f:
-      case_files = pickle.load(f)
-  else:
-    case_files = get_file_list(output_dir)
+  for project in projects:
+    os.makedirs(project.output_dir, mode=0o770, exist_ok=True)
 
-  if save_query_file is not None and not os.path.exists(save_query_file):
-    with open(save_query_file, 'wb') as f:
-      pickle.dump(case_files, f)
+  # Get the file list and filter for the ones we want to process. This is a
+  # pipeline: cases flow through the filters and are submitted as soon as
+  # they are listed, while the rest of the query continues. With several
+  # projects there is still one pipeline, taking cases from each in turn.
+  case_files = interleave(*(project.case_files() for project in projects))
 
   if metadata_only:
+    for _ in case_files:
+      pass
     quit()
 
-  if not run_anyway:
-    case_files = filter(are_files_needed, case_files)
-
-  if whitelist:
-    case_files = filter(lambda c: c.case_id in whitelist, case_files)
+  # One listing of the output directory answers whether files exist for every
+  # case. Checksum files are read on a thread pool.
+  probe = OutputProbe()
+  def needs_job(project_case):
+    (project, case_file_set) = project_case
+    return project.needs_job(case_file_set, probe, run_anyway)
 
+  case_files = threaded_filter(needs_job, case_files)
 
   if dry_run:
-    cnt = 0
-    for _ in case_files:
-      cnt += 1
-    print(f'{cnt} cases need one or more downloads')
+    cnt = {project: 0 for project in projects}
+    for (project, _) in case_files:
+      cnt[project] += 1
+    for project in projects:
+      print(f'{project.project_id}: {cnt[project]} cases need one or more downloads')
     quit()
 
-  # A pool of workers. Each worker will manage a job in the batch system
+  # A pool of workers. Each worker will manage a job in the batch system. The
+  # pool is shared, so --num-jobs limits the jobs of all projects together.
   p = Pool(num_jobs)
 
   # Create jobs for each file
   submitted_jobs = []
   cnt = 0
-  for fn in case_files:
+  for (project, fn) in case_files:
+    resume = project.jobs.get(fn.case_id)
+    if resume and resume['state'] == 'submitted':
+      # Reattach to the job submitted before the restart
+      project.in_flight.discard(fn.case_id)
+      submitted_jobs.append((project, p.apply_async(project.job(fn, max_attempts, retry_delay, resume))))
+      continue
     if cnt>=stop_after:
-      break
+      if not any(pr.in_flight for pr in projects):
+        break
+      continue
     cnt += 1
     if cnt<=start_after:
       continue
 
-    submitted_jobs.append(p.apply_async(Job(fn, cancer, logdir)))
+    submitted_jobs.append((project, p.apply_async(project.job(fn, max_attempts, retry_delay))))
 
   # Wait for them to finish
-  for submitted_job in submitted_jobs:
-    submitted_job.get()
+  failed = {project: 0 for project in projects}
+  for (project, submitted_job) in submitted_jobs:
+    if not submitted_job.get():
+      failed[project] += 1
+  for project in projects:
+    if failed[project]:
+      print(f'{failed[project]} {project.project_id} cases failed every attempt, see {project.failed_file}')
 #-----------------------------------------------------------------------------
 
 
@@ -0,0 +1,333 @@
+'''
+Reproducible benchmarks against a local mock GDC server (see mock_gdc_server.py).
+
+Each scenario starts its own mock server, runs the helpers code against it and
+records wall time, bytes moved and request counts. Results are written as JSON
+so runs can be compared, e.g.
+
+  python benchmark.py --output-file before.json
+  ... change something ...
+  python benchmark.py --output-file after.json --compare before.json
+'''
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from mock_gdc_server import MockConfig, MockGDCServer, RANGE
+
+FORMAT_VERSION = 1
+
+# Seconds single_file_download.py may add to bare interpreter startup, and
+# modules it must not import before they are needed
+STARTUP_BUDGET = 0.25
+STARTUP_FORBIDDEN = ['requests', 'pycurl', 'blessings', 'drmaa']
+
+
+class SkipScenario(Exception):
+  pass
+
+
+def _helpers(server):
+  import helpers
+  helpers.GDC_ENDPOINT = server.url
+  return helpers
+
+
+def _download_all(server, out_dir, use_pycurl):
+  helpers = _helpers(server)
+  for module in ['requests', 'pycurl'] if use_pycurl else ['requests']:
+    if importlib.util.find_spec(module) is None:
+      raise SkipScenario(f'No module named {module!r}')
+  helpers.GDCFileDownloader.retry_delay = 0
+
+  total = 0
+  ok = True
+  for fl, _ in server.dataset.files.values():
+    dl = helpers.GDCFileDownloader(fl['file_id'], os.path.join(out_dir, fl['file_name']),
+                                   expected_file_size=fl['file_size'], md5sum=fl['md5sum'],
+                                   pycurl=use_pycurl, progress_callback=lambda *args, **kwargs: None)
+    ok = dl() and ok
+    total += fl['file_size']
+  return {'bytes': total, 'ok': ok}
+
+
+#-----------------------------------------------------------------------------
+# Scenarios. Each takes the running server and a scratch directory.
+#-----------------------------------------------------------------------------
+def scenario_iterator_paging(server, out_dir):
+  helpers = _helpers(server)
+  filters = {'op': '=', 'content': {'field': 'project.project_id', 'value': 'TCGA-MOCK'}}
+  cases = 0
+  files = 0
+  for case in helpers.GDCIterator('cases', filters):
+    cases += 1
+    file_filters = {'op': '=', 'content': {'field': 'cases.submitter_id', 'value': case['submitter_id']}}
+    for _ in helpers.GDCIterator('files', file_filters):
+      files += 1
+  return {'cases': cases, 'files': files, 'ok': cases == server.config.cases}
+
+
+def scenario_download_pycurl(server, out_dir):
+  return _download_all(server, out_dir, use_pycurl=True)
+
+
+def scenario_download_requests(server, out_dir):
+  return _download_all(server, out_dir, use_pycurl=False)
+
+
+'''
+Each file's connection is dropped part way, twice. The download must resume
+with a Range request rather than start again, so each file is served less than
+twice over.
+'''
+def scenario_resume_after_drop(server, out_dir):
+  result = _download_all(server, out_dir, use_pycurl=True)
+  resumed = True
+  for file_id, (fl, _) in server.dataset.files.items():
+    ranges = server.data_requests.get(file_id, [])
+    if len(ranges) <= server.config.max_drops or server.bytes_served.get(file_id, 0) >= 2 * fl['file_size']:
+      resumed = False
+    for r in ranges[1:]:
+      m = RANGE.match(r or '')
+      if not m or int(m.group(1)) == 0:
+        resumed = False
+  result['bytes_served'] = sum(server.bytes_served.values())
+  result['ok'] = result['ok'] and resumed
+  return result
+
+
+'''
+Every file first gets more error bodies than GDCFileDownloader.max_error_payloads.
+A pycurl download should give up after exactly that many requests rather than
+retrying until the errors stop, a requests download (never retried) after one.
+'''
+def scenario_error_payload(server, out_dir):
+  helpers = _helpers(server)
+  if importlib.util.find_spec('requests') is None:
+    raise SkipScenario("No module named 'requests'")
+  helpers.GDCFileDownloader.retry_delay = 0
+  backends = [True, False] if importlib.util.find_spec('pycurl') else [False]
+
+  gave_up = True
+  downloads = 0
+  expected = 0
+  for use_pycurl in backends:
+    for fl, _ in server.dataset.files.values():
+      path = os.path.join(out_dir, f'{int(use_pycurl)}-{fl["file_name"]}')
+      dl = helpers.GDCFileDownloader(fl['file_id'], path, expected_file_size=fl['file_size'], md5sum=fl['md5sum'],
+                                     pycurl=use_pycurl, progress_callback=lambda *args, **kwargs: None)
+      gave_up = not dl() and gave_up
+      downloads += 1
+      expected += helpers.GDCFileDownloader.max_error_payloads if use_pycurl else 1
+    server.errors.clear()
+  return {'downloads': downloads, 'ok': gave_up and server.requests == expected}
+
+
+def scenario_download_slice(server, out_dir):
+  helpers = _helpers(server)
+  if importlib.util.find_spec('requests') is None:
+    raise SkipScenario("No module named 'requests'")
+  helpers.GDCFileDownloader.retry_delay = 0
+
+  # A gene panel sized region list, sent in three requests
+  regions = [f'chr1:{100000 * n + 1}-{100000 * n + 5000}' for n in range(1200)]
+  total = 0
+  ok = True
+  for fl, _ in server.dataset.files.values():
+    path = os.path.join(out_dir, fl['file_name'])
+    dl = helpers.GDCSliceDownloader(fl['file_id'], path, regions, progress_callback=lambda *args, **kwargs: None)
+    ok = dl() and helpers.slice_record(path, regions) is not None and ok
+    total += os.path.getsize(path) if os.path.exists(path) else 0
+  return {'bytes': total, 'ok': ok}
+
+
+def scenario_md5_verify(server, out_dir):
+  from helpers import md5sum
+  total = 0
+  ok = True
+  for fl, data in server.dataset.files.values():
+    fn = os.path.join(out_dir, fl['file_name'])
+    with open(fn, 'wb') as f:
+      f.write(data)
+    ok = md5sum(fn) == fl['md5sum'] and ok
+    total += len(data)
+  return {'bytes': total, 'ok': ok}
+
+
+def scenario_startup(server, out_dir):
+  here = os.path.dirname(os.path.abspath(__file__))
+
+  def best_of(args, n=5):
+    times = []
+    for _ in range(n):
+      start = time.perf_counter()
+      subprocess.run([sys.executable] + args, cwd=here, stdout=subprocess.DEVNULL, check=True)
+      times.append(time.perf_counter() - start)
+    return min(times)
+
+  bare = best_of(['-c', 'pass'])
+  script = best_of(['single_file_download.py', '--help'])
+  check = 'import sys, single_file_download; print(",".join(m for m in %r if m in sys.modules))' % STARTUP_FORBIDDEN
+  loaded = subprocess.run([sys.executable, '-c', check], cwd=here, capture_output=True, text=True, check=True)
+  loaded = [m for m in loaded.stdout.strip().split(',') if m]
+  overhead = script - bare
+  return {'interpreter_seconds': bare, 'overhead_seconds': overhead, 'budget_seconds': STARTUP_BUDGET,
+          'eager_imports': loaded, 'ok': overhead <= STARTUP_BUDGET and not loaded}
+
+
+MB = 1000000
+
+SCENARIOS = {
+  'iterator_paging': (scenario_iterator_paging,
+                      MockConfig(cases=1200, files_per_case=2, file_size=1, latency=0.005)),
+  'download_pycurl': (scenario_download_pycurl,
+                      MockConfig(cases=2, files_per_case=2, file_size=50 * MB)),
+  'download_requests': (scenario_download_requests,
+                        MockConfig(cases=2, files_per_case=2, file_size=50 * MB)),
+  'resume_after_drop': (scenario_resume_after_drop,
+                        MockConfig(cases=1, files_per_case=2, file_size=50 * MB, drop_after=20 * MB, max_drops=2)),
+  'error_payload': (scenario_error_payload,
+                    MockConfig(cases=1, files_per_case=2, file_size=1 * MB, error_payloads=5)),
+  'download_slice': (scenario_download_slice,
+                     MockConfig(cases=2, files_per_case=2, file_size=50 * MB)),
+  'md5_verify': (scenario_md5_verify,
+                 MockConfig(cases=2, files_per_case=2, file_size=100 * MB)),
+  'startup': (scenario_startup,
+              MockConfig(cases=0)),
+}
+#-----------------------------------------------------------------------------
+
+
+def run_scenario(name, repeat, verbose):
+  fn, config = SCENARIOS[name]
+  times = []
+  result = {}
+  for _ in range(repeat):
+    server = MockGDCServer(config).start()
+    try:
+      with tempfile.TemporaryDirectory() as out_dir:
+        sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        start = time.perf_counter()
+        with sink:
+          result = fn(server, out_dir)
+        times.append(time.perf_counter() - start)
+      result['requests'] = server.requests
+    except (SkipScenario, ImportError) as ex:
+      return {'skipped': str(ex), 'config': config.as_dict()}
+    finally:
+      server.stop()
+
+  seconds = statistics.median(times)
+  result['seconds'] = seconds
+  result['runs'] = times
+  if 'bytes' in result and seconds > 0:
+    result['mb_per_s'] = result['bytes'] / MB / seconds
+  result['config'] = config.as_dict()
+  return result
+
+
+def compare(results, baseline, tolerance):
+  regressed = False
+  print(f'{"scenario":24} {"baseline s":>12} {"current s":>12} {"change":>8}')
+  for name, r in results.items():
+    b = baseline.get('results', {}).get(name)
+    if not b or 'seconds' not in b or 'seconds' not in r:
+      print(f'{name:24} {"n/a":>12}')
+      continue
+    change = r['seconds'] / b['seconds'] - 1 if b['seconds'] else 0.0
+    flag = ''
+    if change > tolerance:
+      flag = '  REGRESSION'
+      regressed = True
+    print(f'{name:24} {b["seconds"]:12.3f} {r["seconds"]:12.3f} {100 * change:7.1f}%{flag}')
+  return regressed
+
+
+def build_parser():
+  parser = ArgumentParser()
+  parser.add_argument('--output-file',
+                      dest='output_file',
+                      help='Write results as JSON to this file',
+                      default=None,
+                      required=False)
+  parser.add_argument('--scenarios',
+                      dest='scenarios',
+                      help='Comma separated scenarios to run. Choices: ' + ','.join(SCENARIOS),
+                      default=','.join(SCENARIOS),
+                      required=False)
+  parser.add_argument('--repeat',
+                      dest='repeat',
+                      help='Run each scenario this many times and report the median',
+                      type=int,
+                      default=3,
+                      required=False)
+  parser.add_argument('--compare',
+                      dest='compare',
+                      help='A previous results file to compare against',
+                      default=None,
+                      required=False)
+  parser.add_argument('--tolerance',
+                      dest='tolerance',
+                      help='Fractional slow down reported as a regression',
+                      type=float,
+                      default=0.2,
+                      required=False)
+  parser.add_argument('--verbose',
+                      dest='verbose',
+                      help='Show output from the code being benchmarked',
+                      action='store_true',
+                      default=False,
+                      required=False)
+  return parser
+
+
+def main(argv):
+  options = build_parser().parse_args(args=argv)
+
+  results = {}
+  for name in options.scenarios.split(','):
+    name = name.strip()
+    if name not in SCENARIOS:
+      print(f'Unknown scenario: {name}')
+      return 2
+    print(f'running {name}')
+    results[name] = run_scenario(name, options.repeat, options.verbose)
+    r = results[name]
+    if 'skipped' in r:
+      print(f'  skipped: {r["skipped"]}')
+    else:
+      print(f'  {r["seconds"]:.3f}s ok={r.get("ok")}' + (f' {r["mb_per_s"]:.1f} MB/s' if 'mb_per_s' in r else ''))
+
+  report = {
+    'format': 'wehi-gdc-benchmark',
+    'version': FORMAT_VERSION,
+    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'host': platform.node(),
+    'python': platform.python_version(),
+    'results': results
+  }
+
+  if options.output_file:
+    with open(options.output_file, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  if options.compare:
+    with open(options.compare) as f:
+      baseline = json.load(f)
+    if compare(results, baseline, options.tolerance):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
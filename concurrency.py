@@ -0,0 +1,107 @@
+'''
+Adaptive download concurrency.
+
+AIMDController grows the number of parallel downloads by one while aggregate
+throughput keeps rising, halves it when connections drop or downloads fail, and
+steps back when another download stopped adding throughput. AdaptivePool runs
+downloads in a multiprocessing pool under such a controller, measuring
+throughput with the shared counters from progress.py.
+'''
+
+import multiprocessing as mp
+import time
+
+from progress import ProgressBoard
+
+
+class AIMDController:
+  def __init__(self, initial=2, minimum=1, maximum=16, decrease=0.5, plateau=0.05, hold=3):
+    self.minimum = minimum
+    self.maximum = max(minimum, maximum)
+    self.limit = min(max(initial, minimum), self.maximum)
+    self.decrease = decrease  # multiplier applied on errors
+    self.plateau = plateau    # fractional gain needed to justify the last increase
+    self.hold = hold          # intervals to wait before probing again after backing off
+    self.holding = 0
+    self.last_limit = self.limit
+    self.last_throughput = 0.0
+
+  '''
+  Called once per measurement interval with the aggregate throughput (bytes/s),
+  the number of errors seen in the interval and the number of downloads that
+  could use a slot. Returns the new limit.
+  '''
+  def update(self, throughput, errors, demand):
+    probed = self.limit > self.last_limit
+    self.last_limit = self.limit
+
+    if errors:
+      self.limit = max(self.minimum, int(self.limit * self.decrease))
+      self.holding = self.hold
+    elif probed and throughput < self.last_throughput * (1 + self.plateau):
+      self.limit = max(self.minimum, self.limit - 1)
+      self.holding = self.hold
+    elif self.holding:
+      self.holding -= 1
+    elif demand > self.limit:
+      self.limit = min(self.maximum, self.limit + 1)
+
+    self.last_throughput = throughput
+    return self.limit
+
+
+class AdaptivePool:
+  def __init__(self, max_workers, controller=None, board=None, interval=30, poll=1):
+    self.controller = controller or AIMDController(maximum=max_workers)
+    self.board = board or ProgressBoard(max_workers)
+    self.pool = mp.Pool(max_workers, **self.board.pool_kwargs())
+    self.interval = interval
+    self.poll = poll
+
+  '''
+  Run (name, downloader) pairs, which may be a lazy iterable, and return the
+  downloader results in the same order.
+  '''
+  def run(self, downloads):
+    downloads = iter(downloads)
+    results = []
+    running = {}
+    exhausted = False
+    failures = 0
+
+    last_time = time.time()
+    last_bytes = self.board.transferred_bytes()
+    last_errors = self.board.errors()
+    while not exhausted or running:
+      while not exhausted and len(running) < self.controller.limit:
+        try:
+          name, dl = next(downloads)
+        except StopIteration:
+          exhausted = True
+          break
+        running[len(results)] = self.pool.apply_async(self.board.track(name, dl))
+        results.append(None)
+
+      time.sleep(self.poll)
+      for i, h in list(running.items()):
+        if h.ready():
+          results[i] = h.get()
+          del running[i]
+          if not results[i]:
+            failures += 1
+
+      now = time.time()
+      if now - last_time >= self.interval:
+        transferred = self.board.transferred_bytes()
+        errors = self.board.errors() + failures
+        throughput = (transferred - last_bytes) / (now - last_time)
+        demand = len(running) + (0 if exhausted else self.controller.limit + 1)
+        old = self.controller.limit
+        limit = self.controller.update(throughput, errors - last_errors, demand)
+        if limit != old:
+          print(f'{throughput / 1e6:.2f} MB/s with {old} downloads, now allowing {limit}')
+        last_time, last_bytes, last_errors = now, transferred, errors
+
+    self.pool.close()
+    self.pool.join()
+    return results
@@ -4,27 +4,8 @@ import os
 import pickle
 import glob
 
-#-----------------------------------------------------------------------------
-'''
-A simple container for files associated with an individual patient
-'''
-class CaseFileSet:
-  def __init__(self, output_dir, case_id):
-    self.file_ids      = []
-    self.file_names    = []
-    self.md5s          = []
-    self.sizes         = []
-    self.submitter_ids = []
-    self.case_id       = case_id
-    self.output_dir    = output_dir
-
-  def add(self, file_id, file_name, md5, size, submitter_id):
-    self.md5s.append(md5)
-    self.file_ids.append(file_id)
-    self.file_names.append(os.path.join(self.output_dir, file_name))
-    self.sizes.append(size)
-    self.submitter_ids.append(submitter_id)
-#-----------------------------------------------------------------------------
+# Needed to unpickle the query file
+from helpers import CaseFileSet
 
 tumour_flags = set(['01','02','03','04','05','06','07','08','09','50','60','61'])
 normal_flags = set(['10','11','12','13','14','40'])
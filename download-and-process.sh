@@ -4,13 +4,44 @@
 # This runs in the batch system:
 # - calls a python script to download the file
 # - if the dl succeeds calls the process.sh script to actually process the file.
+#
+# Set GDC_STAGING_DIR (e.g. to $TMPDIR or a node local SSD) to download there
+# instead of the shared output directory. process.sh is then given the local
+# paths. Set GDC_COPY_BACK=1 to also copy the verified downloads to the output
+# directory while process.sh runs. Staged files are removed when the job ends.
+#
+# Set GDC_POST_DOWNLOAD to a hook in post_download.py, e.g.
+# post_download:bam_summary, to write header and read count summaries next to
+# the downloads before process.sh runs.
 
 hostname
 
 # Setup your python enviroment. This may be a virtual env or a conda
 module load python/3.7.0
 
-CMD="python -u single_file_download.py --output-paths $1 --file-ids $2 --md5sums $3 --sizes $4"
+ARGS="--output-paths $1 --file-ids $2 --md5sums $3 --sizes $4"
+FILES=$1
+
+# Index files (e.g. .bai) are downloaded next to their files
+if [ -n "$7" ]
+then
+  # With = as the value may start with - in older jobs
+  ARGS="$ARGS --index-files=$7"
+fi
+
+if [ -n "$GDC_STAGING_DIR" ]
+then
+  STAGING_DIR=$GDC_STAGING_DIR/gdc-$$
+  PATHS_FILE=$STAGING_DIR.paths
+  ARGS="$ARGS --staging-dir $STAGING_DIR"
+  trap 'rm -rf $STAGING_DIR $PATHS_FILE' EXIT
+fi
+
+CMD="python -u single_file_download.py $ARGS"
+if [ -n "$STAGING_DIR" ]
+then
+  CMD="$CMD --paths-file $PATHS_FILE"
+fi
 echo $CMD
 
 # Stop queue from overloading
@@ -23,5 +54,26 @@ $CMD
 
 if [ $? == "0" ]
 then
-  ../process.sh $1 $5 $6
+  if [ -n "$STAGING_DIR" ]
+  then
+    FILES=$(cat $PATHS_FILE)
+    if [ -n "$GDC_COPY_BACK" ]
+    then
+      python -u single_file_download.py $ARGS --publish &
+      COPY_PID=$!
+    fi
+  fi
+
+  ../process.sh $FILES $5 $6
+  RC=$?
+
+  if [ -n "$COPY_PID" ]
+  then
+    wait $COPY_PID || RC=1
+  fi
+  exit $RC
+else
+  # Fail the job so the batch leader resubmits it
+  echo "Download failed"
+  exit 1
 fi
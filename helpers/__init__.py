@@ -0,0 +1,42 @@
+'''
+Helpers for GDC queries and downloads.
+
+The code is split into submodules that are only imported the first time one of
+their names is used, so a short batch job only pays for what it needs:
+- helpers.query     GDCIterator, FileRecord and CaseFileSet
+- helpers.auth      the auth providers and the GDC error types
+- helpers.download  GDCFileDownloader and its checkpoint and locking support, and
+                    GDCSliceDownloader for regions of a BAM
+- helpers.cache     FileCache, a download cache shared between projects
+requests and pycurl are imported by the functions that use them.
+
+`from helpers import GDCIterator` etc. work as before.
+'''
+
+import importlib
+import os
+
+# Override with the GDC_ENDPOINT environment variable, e.g. to point at mock_gdc_server.py
+GDC_ENDPOINT = os.environ.get('GDC_ENDPOINT', 'https://api.gdc.cancer.gov/')
+
+_SUBMODULES = {
+  'query': ['GDCIterator', 'CaseFileSet', 'FileRecord', 'field_values', 'aggregate'],
+  'auth': ['GDCErrorPayload', 'looks_like_error_payload', 'GDCAuthError', 'GDCAuthProvider', 'GDCFileAuthProvider'],
+  'download': ['DownloadCheckpoint', 'DownloadLock', 'BasicProgressMeter', 'GDCFileDownloader', 'md5sum',
+               'GDCSliceDownloader', 'read_regions', 'slice_record', 'join_bams'],
+  'cache': ['FileCache'],
+}
+_LAZY = {name: module for (module, names) in _SUBMODULES.items() for name in names}
+
+
+def __getattr__(name):
+  module = _LAZY.get(name)
+  if module is None:
+    raise AttributeError(f"module 'helpers' has no attribute '{name}'")
+  value = getattr(importlib.import_module(f'helpers.{module}'), name)
+  globals()[name] = value
+  return value
+
+
+def __dir__():
+  return sorted(list(globals()) + list(_LAZY))
@@ -0,0 +1,92 @@
+from abc import ABC, abstractmethod
+
+import os
+import time
+
+import helpers
+
+'''
+Raised when GDC answers a data request with an error message instead of file
+content, e.g. an expired token still gets HTTP 200 with a JSON error body.
+'''
+class GDCErrorPayload(Exception):
+  pass
+
+def looks_like_error_payload(content_type, data):
+  if content_type and content_type.split(';')[0].strip() in ('application/json', 'text/html'):
+    return True
+  head = data[:1024].lstrip()
+  return head.startswith(b'{"') and (b'error' in head or b'message' in head)
+
+'''
+Raised when the GDC token is rejected.
+'''
+class GDCAuthError(Exception):
+  pass
+
+'''
+A class that provides the authentication token for controlled access data.
+And an implementation that will read the token from a file.
+
+validate() checks the token with a one byte ranged request for a file, so an
+expired token is found before hours are spent on a download. A successful check
+is cached for validation_ttl seconds.
+'''
+class GDCAuthProvider(ABC):
+  validation_ttl = 600
+
+  @abstractmethod
+  def get_token(self):
+    raise NotImplemented
+
+  def add_auth_header(self, headers):
+    headers['X-Auth-Token'] = self.get_token()
+    return headers
+
+  def invalidate(self):
+    self.valid_until = 0
+
+  def validate(self, file_id):
+    token = self.get_token()
+    if getattr(self, 'valid_token', None) == token and time.time() < getattr(self, 'valid_until', 0):
+      return
+
+    import requests
+
+    headers = {'X-Auth-Token': token, 'Range': 'bytes=0-0'}
+    try:
+      with requests.get(f'{helpers.GDC_ENDPOINT}data/{file_id}', headers=headers, stream=True, timeout=60) as r:
+        head = next(r.iter_content(chunk_size=1024), b'')
+        if r.status_code in (401, 403) or looks_like_error_payload(r.headers.get('content-type'), head):
+          raise GDCAuthError(f'GDC rejected the token: {r.status_code} {head[:1024].decode(errors="replace")}')
+        r.raise_for_status()
+    except requests.exceptions.RequestException as ex:
+      # Can't tell, so don't fail the download over it, and don't cache it either
+      print(f'Could not validate the GDC token: {ex}')
+      return
+
+    self.valid_token = token
+    self.valid_until = time.time() + self.validation_ttl
+
+class GDCFileAuthProvider(GDCAuthProvider):
+  def __init__(self, token_file=os.path.join(os.path.expanduser('~'), '.gdc-user-token.txt')):
+    self.token_file = token_file
+    self.token_stat = None
+    self._load()
+
+  def _load(self):
+    st = os.stat(self.token_file)
+    with open(self.token_file, 'r') as file:
+      self.token = file.read().replace('\n', '')
+    self.token_stat = (st.st_mtime_ns, st.st_size)
+
+  def get_token(self):
+    # Pick up a refreshed token without restarting the job
+    try:
+      st = os.stat(self.token_file)
+      if (st.st_mtime_ns, st.st_size) != self.token_stat:
+        print(f'{self.token_file} changed, reloading token')
+        self._load()
+    except OSError as ex:
+      print(f'Could not check {self.token_file}, using the token already read: {ex}')
+    return self.token
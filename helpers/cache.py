@@ -0,0 +1,190 @@
+import os
+import errno
+import fcntl
+import hashlib
+import shutil
+import time
+import uuid
+
+# ioctl(2) request to clone a file's extents (Linux FICLONE)
+FICLONE = 0x40049409
+
+'''
+A content addressed cache of GDC files shared between projects and users.
+
+Objects are stored under objects/ named by GDC file id and md5sum. A cache hit
+is placed at the requested output path as a hard link, a reflink or, failing
+both, a symbolic link, so a 30GB BAM is downloaded once per site rather than
+once per project directory. Downloads are added to the cache the same way,
+copying only when neither kind of link is possible.
+
+Objects are evicted least recently used first once the cache is over its quota.
+An object is in use, and never evicted, while another hard link to it exists
+or while a symbolic link recorded under refs/ still points at it. Reflinked
+outputs are independent copies so don't hold objects.
+'''
+class FileCache:
+  def __init__(self, root, quota=None):
+    self.root = root
+    self.quota = quota
+    self.objects = os.path.join(root, 'objects')
+    self.refs = os.path.join(root, 'refs')
+    os.makedirs(self.objects, mode=0o2775, exist_ok=True)
+    os.makedirs(self.refs, mode=0o2775, exist_ok=True)
+
+  def _key(self, file_id, md5sum):
+    return f'{file_id}.{md5sum}'
+
+  def _object(self, file_id, md5sum):
+    return os.path.join(self.objects, md5sum[:2], self._key(file_id, md5sum))
+
+  def lookup(self, file_id, md5sum):
+    path = self._object(file_id, md5sum)
+    return path if os.path.exists(path) else None
+
+  '''
+  Place a cached copy at output_path. Returns False on a miss.
+  '''
+  def fetch(self, file_id, md5sum, output_path):
+    obj = self.lookup(file_id, md5sum)
+    if obj is None:
+      return False
+
+    try:
+      how = self._place(obj, output_path)
+    except FileNotFoundError:
+      # Evicted since the lookup
+      return False
+    if how == 'symlink':
+      self._add_ref(file_id, md5sum, output_path)
+
+    # Mark it recently used
+    os.utime(obj)
+    print(f'{output_path}: {how} from cache {obj}')
+    return True
+
+  '''
+  Add a verified download to the cache, then evict if over quota.
+  '''
+  def add(self, file_id, md5sum, path):
+    obj = self._object(file_id, md5sum)
+    if not os.path.exists(obj):
+      os.makedirs(os.path.dirname(obj), mode=0o2775, exist_ok=True)
+      tmp = f'{obj}.tmp.{uuid.uuid4().hex}'
+      how = self._link_or_copy(path, tmp)
+      os.replace(tmp, obj)
+      print(f'{path}: added to cache by {how}')
+    self.evict()
+
+  def _place(self, obj, output_path):
+    tmp = f'{output_path}.cache.{uuid.uuid4().hex}'
+    try:
+      os.link(obj, tmp)
+      how = 'hardlink'
+    except OSError as ex:
+      if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+        raise
+      if self._reflink(obj, tmp):
+        how = 'reflink'
+      else:
+        os.symlink(os.path.abspath(obj), tmp)
+        how = 'symlink'
+    os.replace(tmp, output_path)
+    return how
+
+  def _link_or_copy(self, src, dst):
+    try:
+      os.link(src, dst)
+      return 'hardlink'
+    except OSError as ex:
+      if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+        raise
+    if self._reflink(src, dst):
+      return 'reflink'
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+  @staticmethod
+  def _reflink(src, dst):
+    try:
+      with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+      return True
+    except OSError:
+      if os.path.exists(dst):
+        os.remove(dst)
+      return False
+
+  def _ref_dir(self, file_id, md5sum):
+    return os.path.join(self.refs, self._key(file_id, md5sum))
+
+  def _add_ref(self, file_id, md5sum, output_path):
+    d = self._ref_dir(file_id, md5sum)
+    os.makedirs(d, mode=0o2775, exist_ok=True)
+    output_path = os.path.abspath(output_path)
+    ref = os.path.join(d, hashlib.md5(output_path.encode()).hexdigest())
+    if not os.path.lexists(ref):
+      os.symlink(output_path, ref)
+
+  def in_use(self, obj, file_id, md5sum):
+    if os.stat(obj).st_nlink > 1:
+      return True
+
+    d = self._ref_dir(file_id, md5sum)
+    try:
+      refs = os.listdir(d)
+    except FileNotFoundError:
+      return False
+    live = False
+    for ref in refs:
+      ref = os.path.join(d, ref)
+      try:
+        output_path = os.readlink(ref)
+        if os.path.islink(output_path) and os.path.realpath(output_path) == os.path.realpath(obj):
+          live = True
+        else:
+          # The output was deleted or replaced
+          os.remove(ref)
+      except FileNotFoundError:
+        # Removed by another process evicting at the same time
+        pass
+    return live
+
+  def _entries(self):
+    for prefix in os.listdir(self.objects):
+      try:
+        names = os.listdir(os.path.join(self.objects, prefix))
+      except FileNotFoundError:
+        continue
+      for name in names:
+        if '.tmp.' in name:
+          continue
+        path = os.path.join(self.objects, prefix, name)
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          # Evicted by another process since the listing
+          continue
+        file_id, md5sum = name.rsplit('.', 1)
+        yield (st.st_mtime, st.st_size, path, file_id, md5sum)
+
+  def size(self):
+    return sum(e[1] for e in self._entries())
+
+  def evict(self):
+    if self.quota is None:
+      return
+
+    entries = sorted(self._entries())
+    total = sum(e[1] for e in entries)
+    for (mtime, size, path, file_id, md5sum) in entries:
+      if total <= self.quota:
+        break
+      try:
+        if self.in_use(path, file_id, md5sum):
+          continue
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+      print(f'Evicted {path} from cache, last used {time.ctime(mtime)}')
@@ -0,0 +1,922 @@
+import os
+import hashlib
+import time
+import traceback
+import json
+import socket
+import struct
+import threading
+import uuid
+import zlib
+
+import helpers
+from helpers.auth import GDCErrorPayload, looks_like_error_payload
+
+'''
+Integrity checkpoints for a partial download, kept in a sidecar file next to it.
+
+The file is hashed in fixed size blocks as it is written. The sidecar records
+the md5 of every completed block, so a restart resumes from the last block that
+still matches what is on disk rather than trusting whatever is at the end of the
+file. A running md5 of the whole file is kept in memory so, when the download
+completes in one process, the final checksum does not need to re-read the file.
+'''
+class DownloadCheckpoint:
+  VERSION = 1
+  BLOCK_SIZE = 16 * 1024 * 1024
+
+  def __init__(self, path, block_size=BLOCK_SIZE):
+    self.path = path
+    self.block_size = block_size
+    self.reset()
+    self.load()
+
+  def reset(self):
+    self.blocks = []
+    self.offset = 0
+    self.complete = False
+    self.block_md5 = hashlib.md5()
+    self.pending = 0
+    self.file_md5 = hashlib.md5()
+    self.file_md5_at_offset = self.file_md5.copy()
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return False
+    try:
+      with open(self.path, 'r') as f:
+        state = json.load(f)
+      if state['version'] != self.VERSION or state['block_size'] != self.block_size:
+        return False
+      self.blocks = state['blocks']
+      self.offset = state['offset']
+      self.complete = state['complete']
+    except (ValueError, KeyError) as ex:
+      print(f'{self.path}: ignoring unreadable checkpoint: {ex}')
+      self.reset()
+      return False
+    # The running md5 can't be restored from disk
+    self.file_md5 = None
+    self.file_md5_at_offset = None
+    return True
+
+  def save(self):
+    state = {
+      'version': self.VERSION,
+      'block_size': self.block_size,
+      'offset': self.offset,
+      'complete': self.complete,
+      'blocks': self.blocks
+    }
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      json.dump(state, f)
+    os.replace(tmp, self.path)
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+  def update(self, data):
+    view = memoryview(data)
+    while view:
+      n = min(len(view), self.block_size - self.pending)
+      self.block_md5.update(view[:n])
+      if self.file_md5 is not None:
+        self.file_md5.update(view[:n])
+      self.pending += n
+      view = view[n:]
+      if self.pending == self.block_size:
+        self._close_block()
+
+  def finish(self, expected_size=None):
+    # A clean end of transfer that is still short isn't complete, the
+    # unverified tail is dropped on the next recover()
+    if expected_size and self.offset + self.pending < expected_size:
+      return
+    if self.pending:
+      self._close_block()
+    self.complete = True
+    self.save()
+
+  def _close_block(self):
+    self.blocks.append(self.block_md5.hexdigest())
+    self.offset += self.pending
+    self.pending = 0
+    self.block_md5 = hashlib.md5()
+    if self.file_md5 is not None:
+      self.file_md5_at_offset = self.file_md5.copy()
+    self.save()
+
+  def _block_ok(self, f, i, file_md5=None):
+    f.seek(i * self.block_size)
+    md5 = hashlib.md5()
+    remaining = self.block_size
+    while remaining:
+      chunk = f.read(min(remaining, 1024 * 1024))
+      if not chunk:
+        break
+      md5.update(chunk)
+      if file_md5 is not None:
+        file_md5.update(chunk)
+      remaining -= len(chunk)
+    return md5.hexdigest() == self.blocks[i]
+
+  def _verify_all(self, f, good):
+    # Cold restart: check every block and rebuild the running md5 in the same
+    # pass, so the final checksum still doesn't need another full read.
+    file_md5 = hashlib.md5()
+    for i in range(good):
+      at_block = file_md5.copy()
+      if not self._block_ok(f, i, file_md5):
+        print(f'{self.path}: block {i} does not match checkpoint')
+        self.file_md5_at_offset = at_block
+        return i
+    self.file_md5_at_offset = file_md5
+    return good
+
+  def _seed(self, f, size):
+    # A partial download from before checkpoints existed. Its complete blocks
+    # are trusted (as before), the partial tail is discarded.
+    print(f'{self.path}: no checkpoint, hashing {size} bytes already downloaded')
+    self.reset()
+    f.seek(0)
+    for _ in range(size // self.block_size):
+      self.update(f.read(self.block_size))
+
+  '''
+  Make the partial file on disk consistent with the checkpoint and return the
+  offset to resume from. In the process that wrote the blocks only the last one
+  is re-read and, if it doesn't match (e.g. another writer touched the file),
+  earlier blocks are checked until a good one is found. After a restart every
+  block is checked.
+  '''
+  def recover(self, output_path):
+    if not os.path.exists(output_path):
+      self.reset()
+      return 0
+
+    size = os.path.getsize(output_path)
+    with open(output_path, 'r+b') as f:
+      if not self.blocks and self.offset == 0 and size >= self.block_size and not os.path.exists(self.path):
+        self._seed(f, size)
+
+      recorded = len(self.blocks)
+      good = min(recorded, size // self.block_size)
+      if self.complete and self.offset <= size:
+        good = len(self.blocks)
+
+      if self.file_md5_at_offset is None:
+        good = self._verify_all(f, good)
+        if good == recorded:
+          self.file_md5 = self.file_md5_at_offset.copy()
+      else:
+        while good > 0 and not self._block_ok(f, good - 1):
+          print(f'{output_path}: block {good - 1} does not match checkpoint')
+          good -= 1
+
+      if good != recorded or self.pending:
+        self.blocks = self.blocks[:good]
+        self.offset = min(good * self.block_size, size)
+        self.complete = False
+        self.block_md5 = hashlib.md5()
+        self.pending = 0
+        if self.file_md5_at_offset is not None and (good == recorded or self.file_md5 is None):
+          self.file_md5 = self.file_md5_at_offset.copy()
+        else:
+          self.file_md5 = None
+          self.file_md5_at_offset = None
+        self.save()
+
+      if size != self.offset:
+        print(f'{output_path}: truncating from {size} to last verified offset {self.offset}')
+        f.truncate(self.offset)
+
+    return self.offset
+
+  def md5sum(self):
+    if self.complete and self.file_md5 is not None:
+      return self.file_md5.hexdigest()
+    return None
+
+'''
+Advisory ownership of a download, shared between processes and hosts.
+
+The owner creates a lock file next to the download with O_EXCL, which is atomic
+on the shared filesystem, and a background thread touches it every heartbeat
+seconds. Another process wanting the same file waits while the heartbeat keeps
+changing. A lock whose heartbeat hasn't moved for stale_after seconds, measured
+on the waiter's own clock so clock skew between nodes doesn't matter, belongs
+to a dead owner and is taken over.
+'''
+class DownloadLock:
+  def __init__(self, path, file_id, heartbeat=60, stale_after=900):
+    self.path = path
+    self.file_id = file_id
+    self.heartbeat = heartbeat
+    self.stale_after = stale_after
+    self.token = uuid.uuid4().hex
+    self.stopped = threading.Event()
+    self.thread = None
+
+  '''
+  The owner and mtime of the lock, or (None, None) if there is no lock. The
+  owner is {} if the lock can't be read, e.g. its owner died between creating
+  and writing it, so it still goes stale and is taken over.
+  '''
+  def _read(self):
+    try:
+      mtime = os.stat(self.path).st_mtime
+    except OSError:
+      return None, None
+    try:
+      with open(self.path, 'r') as f:
+        owner = json.load(f)
+    except (OSError, ValueError):
+      owner = {}
+    return owner, mtime
+
+  def try_acquire(self):
+    try:
+      fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o660)
+    except FileExistsError:
+      return False
+    with os.fdopen(fd, 'w') as f:
+      json.dump({'file_id': self.file_id, 'host': socket.gethostname(), 'pid': os.getpid(),
+                 'token': self.token, 'started': time.time()}, f)
+    self.stopped.clear()
+    self.thread = threading.Thread(target=self._beat, daemon=True)
+    self.thread.start()
+    return True
+
+  def _beat(self):
+    while not self.stopped.wait(self.heartbeat):
+      try:
+        os.utime(self.path)
+      except OSError as ex:
+        print(f'{self.path}: heartbeat failed: {ex}')
+
+  def _break(self, owner):
+    # Move the stale lock aside, then make sure what was moved is the lock we
+    # judged stale and not one another waiter has just created.
+    aside = f'{self.path}.stale.{self.token}'
+    try:
+      os.rename(self.path, aside)
+    except FileNotFoundError:
+      return
+    try:
+      with open(aside, 'r') as f:
+        moved = json.load(f)
+    except (OSError, ValueError):
+      moved = None
+    if moved and moved.get('token') != owner.get('token'):
+      try:
+        os.link(aside, self.path)
+      except FileExistsError:
+        pass
+    os.remove(aside)
+
+  '''
+  Block until the lock is held. on_wait is called each poll while another
+  process owns the file and can return True to stop waiting (e.g. because the
+  owner has finished the download), in which case False is returned.
+  '''
+  def acquire(self, poll=30, on_wait=None):
+    last_seen = None
+    changed_at = time.monotonic()
+    announced = False
+    while not self.try_acquire():
+      owner, mtime = self._read()
+      if owner is None:
+        # Released since try_acquire
+        continue
+      who = f'{owner.get("host")}:{owner.get("pid")}' if owner else 'unknown'
+      if (owner.get('token'), mtime) != last_seen:
+        last_seen = (owner.get('token'), mtime)
+        changed_at = time.monotonic()
+      elif time.monotonic() - changed_at > self.stale_after:
+        print(f'{self.path}: owner {who} stopped heartbeating, taking over')
+        self._break(owner)
+        continue
+
+      if not announced:
+        print(f'{self.path}: being downloaded by {who}, waiting')
+        announced = True
+      if on_wait is not None and on_wait():
+        return False
+      time.sleep(poll)
+    return True
+
+  def release(self):
+    self.stopped.set()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    owner, _ = self._read()
+    if owner and owner.get('token') == self.token:
+      os.remove(self.path)
+
+'''
+Downloads a file from GDC
+'''
+
+class BasicProgressMeter:
+  def __init__(self):
+    self.sum = 0
+    self.cnt = 0
+  def __call__(self, file_name, total_length, chunk_length, **kwargs):
+    self.sum = self.sum + chunk_length
+    if self.cnt % 1024 == 0:
+      print(f'{file_name}: {self.sum}/{total_length}')
+    self.cnt = self.cnt + 1
+
+class GDCFileDownloader:
+  CURL = 'curl -H "Content-Type: application/json" {auth_header} {endpoint}data/{file_id} -o {output_path}'
+
+  # Seconds to wait before reconnecting after GDC drops a connection
+  retry_delay = 60
+
+  # Seconds between checks while another process owns the download
+  lock_poll = 30
+
+  # Error messages from GDC in place of data before giving up, even if the token checks out
+  max_error_payloads = 3
+
+  def __init__(self, file_id, output_path, expected_file_size=None, md5sum=None, auth_provider=None, pycurl=True, progress_callback=None, cache=None):
+    self.file_id = file_id
+    self.output_path = output_path
+    self.auth_provider = auth_provider
+    self.progress_callback = progress_callback
+    self.md5sum = md5sum
+    self.sum_file = os.path.splitext(output_path)[0] + '.md5'
+    self.checkpoint_file = os.path.splitext(output_path)[0] + '.ckpt'
+    self.lock_file = os.path.splitext(output_path)[0] + '.lock'
+    self.pycurl = pycurl
+    self.expected_file_size = expected_file_size
+    self.cache = cache
+
+  def _check_md5(self):
+    if self.md5sum is None:
+      print('No expected checksum')
+      return False
+
+    if not os.path.exists(self.sum_file):
+      print('checksum file is missing')
+      return False
+
+    with open(self.sum_file, 'r') as f:
+      md5sum = f.read().strip()
+
+    if md5sum == self.md5sum:
+      return True
+    else:
+      print(f'checksum fail. expected: {self.md5sum}  got: {md5sum}')
+      return False
+
+  def curl(self):
+    if self.auth_provider in None:
+      auth_header = ''
+    else:
+      auth_header = f'-H "X-Auth-Token: {self.auth_provider.get_token()}"'
+
+    return self.CURL.format(auth_header=auth_header, endpoint=helpers.GDC_ENDPOINT, output_path=self.output_path, file_id=self.file_id)
+
+  def __call__(self):
+    try:
+      self._do_download()
+      return True
+    except Exception as ex:
+      print(ex)
+      traceback.print_exc()
+      return False
+
+  def _get_endpoint(self):
+    return f'{helpers.GDC_ENDPOINT}data/{self.file_id}'
+
+  def _do_download(self):
+    print(f'{self.output_path}: Start processing.')
+    if self._check_md5():
+      print(f'{self.output_path}: m5sum matches expected m5sum, skipping download.')
+      return
+
+    # Only one process may write the file. Anyone else waits for the owner and
+    # uses its result if the download succeeded.
+    lock = DownloadLock(self.lock_file, self.file_id)
+    if not lock.acquire(poll=self.lock_poll, on_wait=self._finished_elsewhere):
+      print(f'{self.output_path}: downloaded by another process.')
+      return
+
+    try:
+      if self._check_md5():
+        print(f'{self.output_path}: downloaded by another process.')
+        return
+
+      if self.cache and self.md5sum and self._fetch_from_cache():
+        return
+
+      if self.auth_provider:
+        self.auth_provider.validate(self.file_id)
+
+      self._unlink_shared_output()
+      start = int(time.time())
+      if self.pycurl:
+        self._do_download_curl()
+      else:
+        self._do_download_requests()
+      print(f'{self.output_path}: download completed in {int(time.time())-start} seconds')
+
+      if self.cache and self.md5sum:
+        self._add_to_cache()
+    finally:
+      lock.release()
+
+  '''
+  The cache is best effort. A cache that can't be read or written, e.g. a full
+  or read only cache filesystem, never fails a download.
+  '''
+  def _fetch_from_cache(self):
+    try:
+      if not self.cache.fetch(self.file_id, self.md5sum, self.output_path):
+        return False
+    except OSError as ex:
+      print(f'{self.output_path}: cache lookup failed: {ex}')
+      return False
+    # Cache objects were verified when they were added
+    self._write_and_check_md5(self.md5sum)
+    if os.path.exists(self.checkpoint_file):
+      os.remove(self.checkpoint_file)
+    return True
+
+  def _add_to_cache(self):
+    try:
+      self.cache.add(self.file_id, self.md5sum, self.output_path)
+    except OSError as ex:
+      print(f'{self.output_path}: not added to cache: {ex}')
+
+  def _unlink_shared_output(self):
+    # Downloads write into the output file in place. If it is a link (e.g. to a
+    # cache object) remove the link first so the shared data is never modified.
+    p = self.output_path
+    if os.path.islink(p) or (os.path.exists(p) and os.stat(p).st_nlink > 1):
+      print(f'{p}: removing link before downloading')
+      os.remove(p)
+
+  def _finished_elsewhere(self):
+    if self.md5sum is None or not os.path.exists(self.sum_file):
+      return False
+    with open(self.sum_file, 'r') as f:
+      return f.read().strip() == self.md5sum
+
+  def _write_and_check_md5(self, md5sum):
+    print(f'{self.output_path}: md5sum={md5sum}')
+
+    with open(self.sum_file, 'w') as f:
+      f.write(md5sum + '\n')
+
+    if not self._check_md5():
+      raise Exception(f'checksum failed for {self.output_path}')
+
+  def _do_download_curl(self):
+    # Here rather than in the transfer so a missing pycurl isn't retried forever
+    import pycurl
+
+    print(f'{self.output_path}: libcurl download starting.')
+    checkpoint = DownloadCheckpoint(self.checkpoint_file)
+
+    # GDC silently, or noisily, drops connections so keep trying until the file is downloaded.
+    retry_cnt = 0
+    error_cnt = 0
+    while True:
+      if checkpoint.complete and self.expected_file_size and checkpoint.offset >= self.expected_file_size:
+        break
+
+      # Downloaded before checkpoints existed
+      if not os.path.exists(checkpoint.path) and self.expected_file_size and \
+          os.path.exists(self.output_path) and os.path.getsize(self.output_path) >= self.expected_file_size:
+        break
+
+      retry_cnt += 1
+      try:
+        self._pycurl_data_transfer(checkpoint)
+      except GDCErrorPayload as ex:
+        # Usually an expired token. Retrying won't help unless the token has changed.
+        error_cnt += 1
+        if self.progress_callback is not None:
+          self.progress_callback(self.output_path, self.expected_file_size or 0, 0, dropped=True)
+        if self.auth_provider:
+          self.auth_provider.invalidate()
+          self.auth_provider.validate(self.file_id)
+        if error_cnt >= self.max_error_payloads:
+          raise
+      except Exception as ex:
+        print(f'pycurl attempt {retry_cnt}')
+        print(ex)
+        traceback.print_exc()
+        if self.progress_callback is not None:
+          self.progress_callback(self.output_path, self.expected_file_size or 0, 0, dropped=True)
+
+      # Indicates not expected file size was passed so
+      # we can't tell if it is all downloaded.
+      if not self.expected_file_size:
+        break
+
+      if checkpoint.complete and checkpoint.offset >= self.expected_file_size:
+        break
+
+      # Try again in a minute
+      time.sleep(self.retry_delay)
+
+    md5 = checkpoint.md5sum()
+    if md5 is None:
+      md5 = md5sum(self.output_path)
+
+    self._write_and_check_md5(md5)
+    checkpoint.remove()
+
+  def _pycurl_data_transfer(self, checkpoint):
+    import pycurl
+
+    curl = pycurl.Curl()
+    curl.setopt(pycurl.URL, self._get_endpoint())
+    curl.setopt(pycurl.CONNECTTIMEOUT, 300)
+
+    # HTTP headers including AUTH if required
+    headers = ['Content-Type: application/json']
+    if self.auth_provider:
+      headers.append(f'X-Auth-Token: {self.auth_provider.get_token()}')
+    curl.setopt(pycurl.HTTPHEADER, headers)
+
+    # If the file exists restart from the last verified checkpoint
+    sz = checkpoint.recover(self.output_path)
+    if sz:
+      print(f'Attempting restart at {sz}')
+      curl.setopt(pycurl.RESUME_FROM, sz)
+      flags = 'r+b'
+    else:
+      flags = 'wb'
+
+    if self.progress_callback is not None:
+      self._install_curl_progress(curl, sz)
+
+    with open(self.output_path, flags) as f:
+      f.seek(sz)
+      error = None
+      first = True
+      status = None
+      content_type = None
+
+      # getinfo() can't be called while perform() runs, so take the status and
+      # Content-Type from the headers as they arrive
+      def header(line):
+        nonlocal status, content_type
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+          status = int(line.split()[1])
+          content_type = None
+        elif line.lower().startswith('content-type:'):
+          content_type = line.split(':', 1)[1].strip()
+
+      def write(data):
+        nonlocal error, first
+        if first:
+          # First data of this transfer, check it is the file we asked for
+          first = False
+          if looks_like_error_payload(content_type, data):
+            error = data[:1024].decode(errors='replace')
+            return 0
+          if sz and status == 200:
+            print(f'{self.output_path}: server ignored the resume request, starting from 0')
+            f.seek(0)
+            f.truncate()
+            checkpoint.reset()
+        f.write(data)
+        checkpoint.update(data)
+
+      curl.setopt(pycurl.HEADERFUNCTION, header)
+      curl.setopt(pycurl.WRITEFUNCTION, write)
+      try:
+        curl.perform()
+        checkpoint.finish(self.expected_file_size)
+      except pycurl.error:
+        # Returning 0 from write aborts the transfer with a write error
+        if error is not None:
+          raise GDCErrorPayload(error)
+        raise
+      finally:
+        if error is not None:
+          print(f'{self.output_path}: GDC returned an error instead of data: {error}')
+        print(curl.errstr())
+        curl.close()
+
+    if error is not None:
+      raise GDCErrorPayload(error)
+
+    if not os.path.exists(self.output_path) or os.path.getsize(self.output_path)<1000:
+      raise Exception(f'{self.output_path}: did not download or is suspiciously short.')
+
+
+  def _install_curl_progress(self, curl, offset):
+    import pycurl
+
+    # libcurl reports cumulative counts for this transfer only, so report the
+    # bytes already on disk once and then the deltas.
+    self.progress_callback(self.output_path, self.expected_file_size or 0, offset, resumed=True)
+
+    last = 0
+    def xferinfo(dltotal, dlnow, ultotal, ulnow):
+      nonlocal last
+      if dlnow != last:
+        self.progress_callback(self.output_path, self.expected_file_size or offset + dltotal, dlnow - last)
+        last = dlnow
+      return 0
+
+    curl.setopt(pycurl.NOPROGRESS, False)
+    curl.setopt(pycurl.XFERINFOFUNCTION, xferinfo)
+
+  def _do_download_requests(self):
+    import requests
+
+    print(f'{self.output_path}: requests download starting.')
+
+    headers = {'Content-Type': 'application/json'}
+    if self.auth_provider:
+      self.auth_provider.add_auth_header(headers)
+
+    md5 = hashlib.md5()
+    progress_callback = self.progress_callback or BasicProgressMeter()
+
+    with requests.get(self._get_endpoint(), headers=headers, stream=True) as r:
+      r.raise_for_status()
+      total_length = int(r.headers['content-length'])
+      with open(self.output_path, 'wb') as f:
+        first = True
+        for chunk in r.iter_content(chunk_size=8192):
+          if chunk:  # filter out keep-alive new chunks
+            if first and looks_like_error_payload(r.headers.get('content-type'), chunk):
+              raise GDCErrorPayload(chunk[:1024].decode(errors='replace'))
+            first = False
+            f.write(chunk)
+            md5.update(chunk)
+            progress_callback(self.output_path, total_length, len(chunk))
+
+    md5sum = md5.hexdigest()
+    self._write_and_check_md5(md5sum)
+
+
+def md5sum(fn):
+  md5 = hashlib.md5()
+  with open(fn, 'rb') as f:
+    for chunk in iter(lambda: f.read(8192), b""):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+
+# The empty block that ends every BGZF (BAM) file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+'''
+Regions for GDCSliceDownloader from a BED file, or from a comma separated list
+such as chr7:55019017-55211628,chr12. BED intervals are 0 based and half open,
+the regions are 1 based and inclusive.
+'''
+def read_regions(spec):
+  if not os.path.exists(spec):
+    return [r.strip() for r in spec.split(',') if r.strip()]
+
+  regions = []
+  with open(spec) as f:
+    for line in f:
+      if not line.strip() or line.startswith(('#', 'track', 'browser')):
+        continue
+      fields = line.split()
+      if len(fields) < 3:
+        regions.append(fields[0])
+      else:
+        regions.append(f'{fields[0]}:{int(fields[1]) + 1}-{fields[2]}')
+  return regions
+
+
+def regions_md5(regions):
+  return hashlib.md5('\n'.join(regions).encode()).hexdigest()
+
+
+def slice_file(output_path):
+  return os.path.splitext(output_path)[0] + '.slice'
+
+
+'''
+The record GDCSliceDownloader keeps next to a complete slice, if the slice is
+still what was downloaded for these regions, otherwise None.
+'''
+def slice_record(output_path, regions):
+  try:
+    with open(slice_file(output_path)) as f:
+      record = json.load(f)
+  except (FileNotFoundError, ValueError):
+    return None
+  if record.get('regions_md5') != regions_md5(regions):
+    return None
+  if not os.path.exists(output_path) or os.path.getsize(output_path) != record.get('size'):
+    return None
+  return record
+
+
+def _bgzf_blocks(f):
+  while True:
+    header = f.read(12)
+    if not header:
+      return
+    if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+      raise ValueError('not a BGZF block')
+    xlen = int.from_bytes(header[10:12], 'little')
+    extra = f.read(xlen)
+    bsize = None
+    pos = 0
+    while pos + 4 <= len(extra):
+      slen = int.from_bytes(extra[pos + 2:pos + 4], 'little')
+      if extra[pos:pos + 2] == b'BC':
+        bsize = int.from_bytes(extra[pos + 4:pos + 6], 'little')
+      pos += 4 + slen
+    if bsize is None:
+      raise ValueError('BGZF block without a size')
+    rest = f.read(bsize + 1 - 12 - xlen)
+    yield header + extra + rest
+
+
+def _bgzf_block(data):
+  compress = zlib.compressobj(6, zlib.DEFLATED, -15)
+  cdata = compress.compress(data) + compress.flush()
+  header = b'\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0' + struct.pack('<H', len(cdata) + 25)
+  return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def _bam_header_length(data):
+  # magic, l_text, text, n_ref, then l_name, name and l_ref for each reference
+  if len(data) < 8:
+    return None
+  pos = 8 + struct.unpack_from('<i', data, 4)[0]
+  if len(data) < pos + 4:
+    return None
+  (n_ref,) = struct.unpack_from('<i', data, pos)
+  pos += 4
+  for _ in range(n_ref):
+    if len(data) < pos + 4:
+      return None
+    pos += 8 + struct.unpack_from('<i', data, pos)[0]
+  return pos if len(data) >= pos else None
+
+
+'''
+Join BAMs of the same file, as the slicing endpoint returns them, into one by
+copying their compressed blocks. Only the first part's header is kept. The
+header of each later part is usually in blocks of its own, otherwise the reads
+sharing its last block are compressed again.
+'''
+def join_bams(parts, output_path):
+  with open(output_path, 'wb') as out:
+    for (n, part) in enumerate(parts):
+      with open(part, 'rb') as f:
+        blocks = _bgzf_blocks(f)
+        if n:
+          data = b''
+          for block in blocks:
+            data += zlib.decompress(block, 31)
+            length = _bam_header_length(data)
+            if length is not None:
+              if length < len(data):
+                out.write(_bgzf_block(data[length:]))
+              break
+        for block in blocks:
+          # Skip the end of file and any other empty blocks
+          if block[-4:] != b'\0\0\0\0':
+            out.write(block)
+    out.write(BGZF_EOF)
+
+
+'''
+Downloads only the reads in some regions of a BAM, through the GDC slicing
+endpoint, instead of the whole file.
+
+Regions are sent regions_per_request at a time. Each response is a BAM of its
+own, kept as a part file until they have all arrived and then joined into
+output_path. List the regions in order, without overlaps, for a coordinate
+sorted result. Slices can't be resumed, so a part whose transfer fails is
+fetched again from the start, but parts already fetched are kept across
+retries and restarts.
+
+GDC publishes no size or md5sum for a slice. A part is complete once it ends
+with the BGZF end of file block. The .md5 file has the md5sum of the joined
+slice, and a .slice file records the regions and size it was made from, so the
+slice is fetched again if the regions change.
+'''
+class GDCSliceDownloader(GDCFileDownloader):
+  regions_per_request = 500
+  max_attempts = 10
+
+  def __init__(self, file_id, output_path, regions, auth_provider=None, progress_callback=None):
+    super().__init__(file_id, output_path, auth_provider=auth_provider, pycurl=False,
+                     progress_callback=progress_callback)
+    self.regions = list(regions)
+    self.slice_file = slice_file(output_path)
+
+  def _get_endpoint(self):
+    return f'{helpers.GDC_ENDPOINT}slicing/view/{self.file_id}'
+
+  def is_complete(self):
+    return slice_record(self.output_path, self.regions) is not None
+
+  def _do_download(self):
+    print(f'{self.output_path}: Start processing {len(self.regions)} regions.')
+    if self.is_complete():
+      print(f'{self.output_path}: slice already downloaded, skipping.')
+      return
+
+    lock = DownloadLock(self.lock_file, self.file_id)
+    if not lock.acquire(poll=self.lock_poll, on_wait=self.is_complete):
+      print(f'{self.output_path}: downloaded by another process.')
+      return
+
+    try:
+      if self.is_complete():
+        print(f'{self.output_path}: downloaded by another process.')
+        return
+
+      if self.auth_provider:
+        self.auth_provider.validate(self.file_id)
+
+      self._unlink_shared_output()
+      start = int(time.time())
+      # Named for the regions, so parts left from other regions are never used
+      prefix = f'{self.output_path}.{regions_md5(self.regions)[:8]}'
+      n = self.regions_per_request
+      parts = []
+      for (i, first) in enumerate(range(0, len(self.regions), n)):
+        part = f'{prefix}.{i:04d}.part'
+        if not os.path.exists(part):
+          self._fetch_part(self.regions[first:first + n], part)
+        parts.append(part)
+
+      tmp = self.output_path + '.tmp'
+      join_bams(parts, tmp)
+      os.replace(tmp, self.output_path)
+      md5 = md5sum(self.output_path)
+      with open(self.sum_file, 'w') as f:
+        f.write(md5 + '\n')
+      record = {'file_id': self.file_id, 'regions_md5': regions_md5(self.regions), 'regions': len(self.regions),
+                'size': os.path.getsize(self.output_path), 'md5sum': md5}
+      with open(self.slice_file + '.tmp', 'w') as f:
+        json.dump(record, f)
+      os.replace(self.slice_file + '.tmp', self.slice_file)
+      for part in parts:
+        os.remove(part)
+      print(f'{self.output_path}: slice of {record["size"]} bytes completed in {int(time.time())-start} seconds')
+    finally:
+      lock.release()
+
+  def _fetch_part(self, regions, part):
+    error_cnt = 0
+    for attempt in range(1, self.max_attempts + 1):
+      try:
+        self._slice_transfer(regions, part + '.tmp')
+        with open(part + '.tmp', 'rb') as f:
+          f.seek(max(0, os.path.getsize(part + '.tmp') - len(BGZF_EOF)))
+          if f.read() != BGZF_EOF:
+            raise Exception(f'{part}: slice is truncated')
+        os.replace(part + '.tmp', part)
+        return
+      except GDCErrorPayload:
+        error_cnt += 1
+        if self.auth_provider:
+          self.auth_provider.invalidate()
+          self.auth_provider.validate(self.file_id)
+        if error_cnt >= self.max_error_payloads:
+          raise
+      except Exception as ex:
+        print(f'slice attempt {attempt}')
+        print(ex)
+        traceback.print_exc()
+      if self.progress_callback is not None:
+        self.progress_callback(self.output_path, 0, 0, dropped=True)
+      time.sleep(self.retry_delay)
+    raise Exception(f'{part}: failed after {self.max_attempts} attempts')
+
+  def _slice_transfer(self, regions, path):
+    import requests
+
+    headers = {'Content-Type': 'application/json'}
+    if self.auth_provider:
+      self.auth_provider.add_auth_header(headers)
+
+    progress_callback = self.progress_callback or BasicProgressMeter()
+    with requests.post(self._get_endpoint(), headers=headers, json={'regions': regions}, stream=True) as r:
+      r.raise_for_status()
+      with open(path, 'wb') as f:
+        first = True
+        for chunk in r.iter_content(chunk_size=65536):
+          if chunk:
+            if first and looks_like_error_payload(r.headers.get('content-type'), chunk):
+              raise GDCErrorPayload(chunk[:1024].decode(errors='replace'))
+            first = False
+            f.write(chunk)
+            progress_callback(self.output_path, 0, len(chunk))
@@ -0,0 +1,324 @@
+import sys
+import os
+import json
+import uuid
+from array import array
+
+import helpers
+
+'''
+This class implements a Python iterator that takes care of 
+paging through the output from a query against the provided API endpoint
+
+fields and expand may be comma separated strings or lists, e.g.
+FileRecord.FIELDS. Ask only for the fields you use, the defaults make for
+much larger pages. With record, each hit is passed through it, e.g.
+FileRecord.from_hit, and the result returned instead.
+'''
+class GDCIterator:
+  def __init__(self, ep, filters, max_count=sys.maxsize, fields=None, expand=None, record=None):
+    self.ep = ep
+    self.filters = filters
+    self.max_count = max_count
+    self.hits = []
+    self.total = 0
+    self.frm = 0
+    self.returned = 0
+    self.fields = fields if fields is None or isinstance(fields, str) else ','.join(fields)
+    self.expand = expand if expand is None or isinstance(expand, str) else ','.join(expand)
+    self.record = record
+
+  def __iter__(self):
+    return self
+
+  def _get_batch(self):
+    query = {
+      'filters': self.filters,
+      'format': 'json',
+      'size': str(min(500, self.max_count)),
+      'from': str(self.frm)
+    }
+    self.frm += 500
+
+    if self.fields:
+      query['fields'] = self.fields
+    if self.expand:
+      query['expand'] = self.expand
+
+    import requests
+
+    retry_count = 0
+    while retry_count < 3:
+      retry_count = retry_count + 1
+      try:
+        r = requests.post(helpers.GDC_ENDPOINT+self.ep, json=query, headers={'Content-Type': 'application/json'})
+        r.raise_for_status()
+        results = _json_loads(r.content)
+        self.hits = results['data']['hits']
+        self.total = int(results['data']['pagination']['total'])
+        return
+      except Exception as ex:
+        print(ex)
+        print(f'attempt {retry_count} of 3')
+        print(f'query:\n{query}')
+
+    raise StopIteration
+
+
+  def __next__(self):
+    if not self.hits:
+      # Everything has been returned, don't ask for an empty page
+      if self.frm and self.returned >= self.total:
+        raise StopIteration
+      self._get_batch()
+
+    self.returned = 1 + self.returned
+    if self.returned > self.total:
+      raise StopIteration
+
+    hit = self.hits.pop(0)
+    return self.record(hit) if self.record else hit
+
+
+'''
+Totals for a query without paging through it: the number of hits and GDC
+aggregations for the facets asked for, from one size=0 request. Facets on text
+fields give {'buckets': [{'key': ..., 'doc_count': ...}]} and on numeric
+fields {'stats': {'count': ..., 'sum': ..., ...}}.
+'''
+def aggregate(ep, filters, facets=()):
+  query = {
+    'filters': filters,
+    'format': 'json',
+    'size': '0'
+  }
+  if facets:
+    query['facets'] = facets if isinstance(facets, str) else ','.join(facets)
+
+  import requests
+
+  retry_count = 0
+  while retry_count < 3:
+    retry_count = retry_count + 1
+    try:
+      r = requests.post(helpers.GDC_ENDPOINT+ep, json=query, headers={'Content-Type': 'application/json'})
+      r.raise_for_status()
+      data = _json_loads(r.content)['data']
+      return (int(data['pagination']['total']), data.get('aggregations', {}))
+    except Exception as ex:
+      print(ex)
+      print(f'attempt {retry_count} of 3')
+      print(f'query:\n{query}')
+
+  raise Exception(f'{ep} aggregation failed')
+
+
+_loads = None
+
+'''
+orjson if it is installed, it parses pages of hits several times faster.
+'''
+def _json_loads(data):
+  global _loads
+  if _loads is None:
+    try:
+      import orjson
+      _loads = orjson.loads
+    except ImportError:
+      _loads = json.loads
+  return _loads(data)
+
+
+'''
+Every value at a dotted field path in a hit, following lists at any level, e.g.
+field_values(hit, 'cases.samples.portions.analytes.aliquots.submitter_id').
+'''
+def field_values(hit, path):
+  values = [hit]
+  for key in path.split('.'):
+    found = []
+    for v in values:
+      v = v.get(key) if isinstance(v, dict) else None
+      if isinstance(v, list):
+        found.extend(v)
+      elif v is not None:
+        found.append(v)
+    values = found
+  return values
+
+
+'''
+A file hit flattened into typed fields. Query with fields=FileRecord.FIELDS.
+aliquots has the submitter id of every aliquot the file was made from, and
+index is (file_id, md5sum, size, extension) of its index file (e.g. a BAM's
+.bai) or None.
+'''
+class FileRecord:
+  FIELDS = [
+    'file_id',
+    'file_name',
+    'md5sum',
+    'file_size',
+    'data_format',
+    'experimental_strategy',
+    'cases.case_id',
+    'cases.samples.portions.analytes.aliquots.submitter_id',
+    'index_files.file_id',
+    'index_files.file_name',
+    'index_files.md5sum',
+    'index_files.file_size'
+  ]
+  __slots__ = ('file_id', 'file_name', 'md5sum', 'file_size', 'data_format', 'experimental_strategy', 'case_ids',
+               'aliquots', 'index')
+
+  def __init__(self, file_id, file_name, md5sum, file_size, data_format=None, experimental_strategy=None,
+               case_ids=(), aliquots=(), index=None):
+    self.file_id = file_id
+    self.file_name = file_name
+    self.md5sum = md5sum
+    self.file_size = file_size
+    self.data_format = data_format
+    self.experimental_strategy = experimental_strategy
+    self.case_ids = list(case_ids)
+    self.aliquots = list(aliquots)
+    self.index = index
+
+  @classmethod
+  def from_hit(cls, hit):
+    index = None
+    if hit.get('index_files'):
+      ix = hit['index_files'][0]
+      index = (ix['file_id'], ix['md5sum'], int(ix['file_size']), os.path.splitext(ix['file_name'])[1])
+    return cls(hit['file_id'], hit['file_name'], hit.get('md5sum'),
+               int(hit['file_size']) if hit.get('file_size') is not None else None,
+               hit.get('data_format'), hit.get('experimental_strategy'),
+               field_values(hit, 'cases.case_id'),
+               field_values(hit, 'cases.samples.portions.analytes.aliquots.submitter_id'),
+               index)
+
+  def __repr__(self):
+    return f'FileRecord({self.file_id}, {self.file_name}, aliquots={self.aliquots})'
+
+'''
+A compact container for the files associated with an individual patient.
+
+It is pickled into the query cache and shipped to every pool worker, so the
+per file fields are stored compactly: UUID file ids and md5sums as raw bytes,
+sizes in an array and file names without the output directory. The list
+attributes the scripts use (file_ids, file_names, md5s, sizes, submitter_ids)
+are rebuilt on access. The pickled form is versioned, and pickles of the old
+dict based class still load.
+
+A file may have an index file (e.g. a BAM's .bai). It is kept next to the file,
+named with the index's extension added, and index_files gives (file_id, md5,
+size, extension) for each file, or None.
+'''
+class CaseFileSet:
+  VERSION = 2
+  __slots__ = ('case_id', 'output_dir', '_ids', '_names', '_md5s', '_sizes', '_submitter_ids', '_indexes')
+
+  def __init__(self, output_dir, case_id):
+    self.case_id = case_id
+    self.output_dir = output_dir
+    self._ids = []
+    self._names = []
+    self._md5s = []
+    self._sizes = array('q')
+    self._submitter_ids = []
+    # Only files with an index have an entry, keyed by position
+    self._indexes = {}
+
+  def add(self, file_id, file_name, md5, size, submitter_id, index=None):
+    if index is not None:
+      (index_id, index_md5, index_size, extension) = index
+      self._indexes[len(self._names)] = (_pack_uuid(index_id), _pack_hex(index_md5), int(index_size), extension)
+    self._ids.append(_pack_uuid(file_id))
+    self._names.append(file_name)
+    self._md5s.append(_pack_hex(md5))
+    self._sizes.append(int(size))
+    self._submitter_ids.append(submitter_id)
+
+  def __len__(self):
+    return len(self._names)
+
+  @property
+  def file_ids(self):
+    return [_unpack_uuid(i) for i in self._ids]
+
+  @property
+  def file_names(self):
+    return [os.path.join(self.output_dir, n) for n in self._names]
+
+  @property
+  def md5s(self):
+    return [_unpack_hex(m) for m in self._md5s]
+
+  @property
+  def sizes(self):
+    return list(self._sizes)
+
+  @property
+  def submitter_ids(self):
+    return list(self._submitter_ids)
+
+  @property
+  def index_files(self):
+    indexes = [None] * len(self._names)
+    for (n, (i, m, sz, ext)) in self._indexes.items():
+      indexes[n] = (_unpack_uuid(i), _unpack_hex(m), sz, ext)
+    return indexes
+
+  @property
+  def index_names(self):
+    return [f + index[3] if index else None for (f, index) in zip(self.file_names, self.index_files)]
+
+  def __getstate__(self):
+    return (self.VERSION, self.case_id, self.output_dir, tuple(self._ids), tuple(self._names),
+            tuple(self._md5s), self._sizes.tobytes(), tuple(self._submitter_ids),
+            tuple(sorted(self._indexes.items())))
+
+  def __setstate__(self, state):
+    if isinstance(state, tuple) and len(state) == 2 and state[1] is None:
+      # Pickles of the dict based class, via the default protocol 2 reduce
+      state = state[0]
+    if isinstance(state, dict):
+      self.__init__(state['output_dir'], state['case_id'])
+      for (i, f, m, sz, sid) in zip(state['file_ids'], state['file_names'], state['md5s'],
+                                    state['sizes'], state['submitter_ids']):
+        self.add(i, os.path.basename(f), m, sz, sid)
+      return
+
+    version = state[0]
+    if version == 1:
+      # Before index files
+      state = state + ((),)
+    elif version != 2:
+      raise ValueError(f'Unsupported CaseFileSet version {version}')
+    (_, self.case_id, self.output_dir, ids, names, md5s, sizes, submitter_ids, indexes) = state
+    self._ids = list(ids)
+    self._names = list(names)
+    self._md5s = list(md5s)
+    self._sizes = array('q')
+    self._sizes.frombytes(sizes)
+    self._submitter_ids = list(submitter_ids)
+    self._indexes = dict(indexes)
+
+def _pack_uuid(s):
+  try:
+    u = uuid.UUID(s)
+  except (ValueError, TypeError, AttributeError):
+    return s
+  return u.bytes if str(u) == s else s
+
+def _unpack_uuid(b):
+  return str(uuid.UUID(bytes=b)) if isinstance(b, bytes) else b
+
+def _pack_hex(s):
+  try:
+    b = bytes.fromhex(s)
+  except (ValueError, TypeError):
+    return s
+  return b if b.hex() == s else s
+
+def _unpack_hex(b):
+  return b.hex() if isinstance(b, bytes) else b
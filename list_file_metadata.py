@@ -2,7 +2,7 @@
 List metadata for all files associated with a case query
 '''
 
-from helpers import GDCIterator
+from helpers import GDCIterator, FileRecord
 import json
 import sys
 from argparse import ArgumentParser
@@ -22,6 +22,16 @@ def build_parser():
                       type=str,
                       default=None,
                       required=True)
+  parser.add_argument('--fields',
+                      dest='fields',
+                      help='Comma separated file fields to list. Defaults to those of FileRecord in helpers/query.py',
+                      default=','.join(FileRecord.FIELDS),
+                      required=False)
+  parser.add_argument('--expand',
+                      dest='expand',
+                      help='Comma separated groups of file fields to list in full, e.g. cases.samples,analysis',
+                      default=None,
+                      required=False)
   return parser
 
 case_filters = {
@@ -66,7 +76,7 @@ def main(argv):
     print(f'case_id: {case_id}, submitter_id: {submitter_id}')
 
     flmds = []
-    for fl in GDCIterator('files', file_filters):
+    for fl in GDCIterator('files', file_filters, fields=options.fields, expand=options.expand):
       flmds.append(fl)
 
     cases.append({'case_id': case_id, 'case': case, 'files': flmds})
@@ -0,0 +1,382 @@
+'''
+A local stand-in for the GDC API, used by benchmark.py.
+
+It serves the endpoints this repository uses:
+- POST /cases  paged case query
+- POST /files  paged file query, filtered on cases.submitter_id, with facets
+- GET  /data/{file_id}  file download with Range support
+- POST /slicing/view/{file_id}  a small BAM with a stand in record for each region
+
+Latency, bandwidth, dropped connections and error bodies in place of data (as
+GDC sends for an expired token) can be configured so tuning
+runs are reproducible and do not touch the production API.
+
+Run standalone with, e.g.
+  python mock_gdc_server.py --port 8080 --cases 100 --files-per-case 2 --file-size 10000000
+and point the download scripts at it with GDC_ENDPOINT=http://localhost:8080/
+'''
+
+import hashlib
+import json
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RANGE = re.compile(r'bytes=(\d+)-(\d*)')
+WRITE_CHUNK = 64 * 1024
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def bgzf_block(data):
+  compress = zlib.compressobj(6, zlib.DEFLATED, -15)
+  cdata = compress.compress(data) + compress.flush()
+  header = b'\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0' + struct.pack('<H', len(cdata) + 25)
+  return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+'''
+A BAM shaped response for the slicing endpoint: a real header, then a block of
+the file's bytes standing in for the reads in each region.
+'''
+def mock_slice(file_id, data, regions):
+  text = f'@HD\tVN:1.6\tSO:coordinate\n@SQ\tSN:chr1\tLN:248956422\n@PG\tID:mock\tCL:{file_id}\n'.encode()
+  header = b'BAM\1' + struct.pack('<i', len(text)) + text + struct.pack('<i', 1)
+  header += struct.pack('<i', 5) + b'chr1\0' + struct.pack('<i', 248956422)
+  out = [bgzf_block(header)]
+  for (n, region) in enumerate(regions):
+    pos = (n * 4096) % max(1, len(data) - 1000)
+    out.append(bgzf_block(region.encode() + data[pos:pos + 1000]))
+  out.append(BGZF_EOF)
+  return b''.join(out)
+
+
+'''
+Server behaviour. All rates are per connection.
+'''
+class MockConfig:
+  def __init__(self, cases=10, files_per_case=2, file_size=1000000, latency=0.0, bandwidth=0,
+               drop_after=0, max_drops=0, error_payloads=0, index_files=False, seed=0):
+    self.cases = cases
+    self.files_per_case = files_per_case
+    self.file_size = file_size
+    self.latency = latency          # seconds added to every request
+    self.bandwidth = bandwidth      # bytes per second for /data, 0 is unlimited
+    self.drop_after = drop_after    # drop a /data connection after this many bytes, 0 never drops
+    self.max_drops = max_drops      # drops per file before the server behaves, 0 is unlimited
+    self.error_payloads = error_payloads  # /data requests per file answered with a JSON error body
+    self.index_files = index_files  # give each BAM a .bai index file
+    self.seed = seed
+
+  def as_dict(self):
+    return dict(self.__dict__)
+
+
+'''
+Deterministic cases and files. File contents are generated from the seed, so
+the md5sums are stable between runs.
+'''
+class MockDataset:
+  def __init__(self, config):
+    self.cases = []
+    self.files = {}
+    self.files_by_case = {}
+    for c in range(config.cases):
+      submitter_id = f'TCGA-MK-{c:04d}'
+      case = {'case_id': f'case-{config.seed}-{c:06d}', 'submitter_id': submitter_id}
+      self.cases.append(case)
+      self.files_by_case[submitter_id] = []
+      for n in range(config.files_per_case):
+        file_id = f'file-{config.seed}-{c:06d}-{n:02d}'
+        data = self._content(file_id, config.file_size)
+        # Sample type 01 (tumour) for the first file, 10 (normal) for the rest
+        sample = '01' if n == 0 else '10'
+        aliquot = f'{submitter_id}-{sample}A-01D-A000-{n:02d}'
+        fl = {
+          'file_id': file_id,
+          'file_name': f'{file_id}.bam',
+          'md5sum': hashlib.md5(data).hexdigest(),
+          'file_size': len(data),
+          'data_format': 'BAM',
+          'experimental_strategy': 'WXS',
+          'cases': [{'samples': [{'portions': [{'analytes': [{'aliquots': [{'submitter_id': aliquot}]}]}]}]}]
+        }
+        if config.index_files:
+          index_id = f'{file_id}-bai'
+          index = self._content(index_id, max(1, config.file_size // 1000))
+          ix = {'file_id': index_id, 'file_name': f'{file_id}.bam.bai', 'md5sum': hashlib.md5(index).hexdigest(),
+                'file_size': len(index)}
+          fl['index_files'] = [ix]
+          self.files[index_id] = (ix, index)
+        self.files[file_id] = (fl, data)
+        self.files_by_case[submitter_id].append(fl)
+
+  @staticmethod
+  def _content(file_id, size):
+    block = hashlib.sha256(file_id.encode()).digest() * 128
+    reps = size // len(block) + 1
+    return (block * reps)[:size]
+
+
+def find_filter_value(filters, field):
+  if isinstance(filters, dict):
+    content = filters.get('content')
+    if isinstance(content, dict) and content.get('field') == field:
+      return content.get('value')
+    return find_filter_value(content, field)
+  if isinstance(filters, list):
+    for f in filters:
+      v = find_filter_value(f, field)
+      if v is not None:
+        return v
+  return None
+
+
+def find_clauses(filters, op, field):
+  if isinstance(filters, list):
+    return [c for f in filters for c in find_clauses(f, op, field)]
+  if not isinstance(filters, dict):
+    return []
+  content = filters.get('content')
+  if filters.get('op') == op and isinstance(content, dict) and content.get('field') == field:
+    return [content.get('value')]
+  return find_clauses(content, op, field)
+
+
+'''
+GDC style aggregations of top level fields: stats for numbers, buckets otherwise.
+'''
+def aggregations(hits, facets):
+  result = {}
+  for field in facets:
+    values = [h[field] for h in hits if field in h]
+    if values and all(isinstance(v, (int, float)) for v in values):
+      result[field] = {'stats': {'count': len(values), 'min': min(values), 'max': max(values),
+                                 'avg': sum(values) / len(values), 'sum': sum(values)}}
+    else:
+      counts = {}
+      for v in values:
+        counts[v] = counts.get(v, 0) + 1
+      result[field] = {'buckets': [{'key': k, 'doc_count': n} for (k, n) in counts.items()]}
+  return result
+
+
+def filter_cases(cases, filters):
+  for ids in find_clauses(filters, 'in', 'case_id'):
+    ids = set(ids)
+    cases = [c for c in cases if c['case_id'] in ids]
+  for ids in find_clauses(filters, 'exclude', 'case_id'):
+    ids = set(ids)
+    cases = [c for c in cases if c['case_id'] not in ids]
+  return cases
+
+
+class MockGDCHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send_json(self, obj, status=200):
+    body = json.dumps(obj).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _query(self):
+    length = int(self.headers.get('Content-Length', 0))
+    return json.loads(self.rfile.read(length) or b'{}')
+
+  def _page(self, hits, query):
+    frm = int(query.get('from', 0))
+    size = int(query.get('size', 10))
+    data = {'hits': hits[frm:frm + size], 'pagination': {'total': len(hits)}}
+    if query.get('facets'):
+      data['aggregations'] = aggregations(hits, query['facets'].split(','))
+    self._send_json({'data': data})
+
+  def do_POST(self):
+    self.server.count_request()
+    time.sleep(self.server.config.latency)
+    query = self._query()
+    ep = self.path.strip('/').split('?')[0]
+    if ep == 'cases':
+      self._page(filter_cases(self.server.dataset.cases, query.get('filters')), query)
+    elif ep == 'files':
+      submitter_id = find_filter_value(query.get('filters'), 'cases.submitter_id')
+      if submitter_id is None:
+        # A project wide query
+        hits = [fl for fls in self.server.dataset.files_by_case.values() for fl in fls]
+      else:
+        hits = self.server.dataset.files_by_case.get(submitter_id, [])
+      self._page(hits, query)
+    elif ep.startswith('slicing/view/') and ep.split('/')[-1] in self.server.dataset.files:
+      file_id = ep.split('/')[-1]
+      body = mock_slice(file_id, self.server.dataset.files[file_id][1], query.get('regions', []))
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+    else:
+      self._send_json({'error': 'unknown endpoint'}, status=404)
+
+  def do_GET(self):
+    config = self.server.config
+    self.server.count_request()
+    time.sleep(config.latency)
+    parts = self.path.strip('/').split('/')
+    if len(parts) != 2 or parts[0] != 'data' or parts[1] not in self.server.dataset.files:
+      self._send_json({'error': 'not found'}, status=404)
+      return
+
+    file_id = parts[1]
+    if self.server.should_error(file_id):
+      # GDC answers 200 with an error message when the token has expired
+      self._send_json({'message': 'Your token is invalid or expired. Please get a new token from the Data Portal.'})
+      return
+
+    _, data = self.server.dataset.files[file_id]
+    self.server.record_data_request(file_id, self.headers.get('Range'))
+    start, end = 0, len(data) - 1
+    m = RANGE.match(self.headers.get('Range', ''))
+    if m:
+      start = int(m.group(1))
+      if m.group(2):
+        end = min(end, int(m.group(2)))
+      if start > end:
+        self.send_response(416)
+        self.send_header('Content-Range', f'bytes */{len(data)}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+    else:
+      self.send_response(200)
+    self.send_header('Content-Type', 'application/octet-stream')
+    self.send_header('Content-Length', str(end - start + 1))
+    self.end_headers()
+
+    drop = self.server.should_drop(file_id)
+    sent = 0
+    began = time.time()
+    pos = start
+    while pos <= end:
+      n = min(WRITE_CHUNK, end + 1 - pos)
+      if drop and sent + n > config.drop_after:
+        n = max(0, config.drop_after - sent)
+        self.wfile.write(data[pos:pos + n])
+        self.wfile.flush()
+        self.server.count_bytes(file_id, n)
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.close_connection = True
+        return
+      self.wfile.write(data[pos:pos + n])
+      self.server.count_bytes(file_id, n)
+      pos += n
+      sent += n
+      if config.bandwidth:
+        ahead = sent / config.bandwidth - (time.time() - began)
+        if ahead > 0:
+          time.sleep(ahead)
+
+
+class MockGDCServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, config, port=0):
+    super().__init__(('127.0.0.1', port), MockGDCHandler)
+    self.config = config
+    self.dataset = MockDataset(config)
+    self.drops = {}
+    self.errors = {}
+    self.requests = 0
+    # Range header of each /data request and bytes sent, by file
+    self.data_requests = {}
+    self.bytes_served = {}
+    self.lock = threading.Lock()
+    self.thread = None
+
+  @property
+  def url(self):
+    return f'http://127.0.0.1:{self.server_address[1]}/'
+
+  def count_request(self):
+    with self.lock:
+      self.requests += 1
+
+  def record_data_request(self, file_id, range_header):
+    with self.lock:
+      self.data_requests.setdefault(file_id, []).append(range_header)
+
+  def count_bytes(self, file_id, n):
+    with self.lock:
+      self.bytes_served[file_id] = self.bytes_served.get(file_id, 0) + n
+
+  def should_drop(self, file_id):
+    if not self.config.drop_after:
+      return False
+    with self.lock:
+      n = self.drops.get(file_id, 0)
+      if self.config.max_drops and n >= self.config.max_drops:
+        return False
+      self.drops[file_id] = n + 1
+      return True
+
+  def should_error(self, file_id):
+    if not self.config.error_payloads:
+      return False
+    with self.lock:
+      n = self.errors.get(file_id, 0)
+      if n >= self.config.error_payloads:
+        return False
+      self.errors[file_id] = n + 1
+      return True
+
+  def start(self):
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+def build_parser():
+  parser = ArgumentParser()
+  parser.add_argument('--port', dest='port', type=int, default=8080)
+  parser.add_argument('--cases', dest='cases', type=int, default=10)
+  parser.add_argument('--files-per-case', dest='files_per_case', type=int, default=2)
+  parser.add_argument('--file-size', dest='file_size', type=int, default=1000000)
+  parser.add_argument('--latency', dest='latency', help='Seconds added to each request', type=float, default=0.0)
+  parser.add_argument('--bandwidth', dest='bandwidth', help='Bytes/s per connection, 0 is unlimited', type=int, default=0)
+  parser.add_argument('--drop-after', dest='drop_after', help='Drop downloads after this many bytes', type=int, default=0)
+  parser.add_argument('--max-drops', dest='max_drops', help='Drops per file, 0 is unlimited', type=int, default=0)
+  parser.add_argument('--error-payloads', dest='error_payloads', help='Error bodies per file before sending data',
+                      type=int, default=0)
+  parser.add_argument('--index-files', dest='index_files', help='Give each BAM a .bai', action='store_true', default=False)
+  return parser
+
+
+def main(argv):
+  options = build_parser().parse_args(args=argv)
+  config = MockConfig(cases=options.cases, files_per_case=options.files_per_case, file_size=options.file_size,
+                      latency=options.latency, bandwidth=options.bandwidth, drop_after=options.drop_after,
+                      max_drops=options.max_drops, error_payloads=options.error_payloads,
+                      index_files=options.index_files)
+  server = MockGDCServer(config, port=options.port)
+  print(f'Mock GDC serving {config.cases} cases at {server.url}')
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -1,14 +1,18 @@
 #!/bin/bash
 
-if [ "$#" -ne 1 ]; then
-    echo Usage: $0 CANCER
+if [ "$#" -lt 1 ]; then
+    echo Usage: $0 CANCER [CANCER ...]
     exit 1
 fi
 
-CANCER=$1
+# Several cancers share one leader and its pool of 50 jobs, taking cases from
+# each cancer in turn
+PROJECTS=$(printf 'TCGA-%s,' "$@")
+PROJECTS=${PROJECTS%,}
+NAME=$(IFS=-; echo "$*")
 
-qsub -j oe -N ${CANCER} -l walltime=300:03:03,nodes=1:ppn=2,mem=2gb <<EOF
+qsub -j oe -N ${NAME:0:15} -l walltime=300:03:03,nodes=1:ppn=2,mem=2gb <<EOF
 hostname
 cd \$PBS_O_WORKDIR
-python -u ./batch_download.py --num-jobs 50 --output-dir /stornext/HPCScratch/PapenfussLab/projects/gdc_download/${CANCER}/ --gdc-project-id TCGA-${CANCER} --save-query-file ${CANCER}-query.pkl --cancer ${CANCER} --run-anyway --whitelist ${CANCER}-whitelist.txt
+python -u ./batch_download.py --num-jobs 50 --output-dir /stornext/HPCScratch/PapenfussLab/projects/gdc_download/{cancer}/ --gdc-project-id ${PROJECTS} --save-query-file {cancer}-query.pkl --run-anyway --whitelist {cancer}-whitelist.txt
 EOF
@@ -0,0 +1,7 @@
+#!/bin/bash
+
+# What is left to download for each cancer, estimated from GDC totals in a
+# couple of requests each (see --plan in batch_download.py)
+CANCERS="BLCA BRCA COAD ESCA HNSC LGG LIHC LUAD LUSC OV PAAD READ SARC SKCM STAD TGCT"
+PROJECTS=$(printf 'TCGA-%s,' $CANCERS)
+python ./batch_download.py --plan --output-dir /stornext/HPCScratch/PapenfussLab/projects/gdc_download/{cancer}/ --gdc-project-id ${PROJECTS%,}
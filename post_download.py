@@ -0,0 +1,122 @@
+'''
+Hooks run by single_file_download.py once a case's files and their index files
+are downloaded and verified, before process.sh is given them. They are for
+cheap artefacts that save process.sh from scanning the whole file again.
+
+Choose one with --post-download or the GDC_POST_DOWNLOAD environment variable,
+as module:function, e.g. post_download:bam_summary. A hook is called as
+  hook(path, index_path, output_path)
+with the path the file was downloaded to (which may be a staging directory),
+its index or None, and the path the file is finally kept at. Artefacts should
+be written next to output_path so they outlive the staging directory.
+'''
+
+import gzip
+import importlib
+import os
+import struct
+
+# The BAI pseudo bin holding a reference's mapped and unmapped read counts
+BAI_PSEUDO_BIN = 37450
+# Bins of the smallest, 16kb, windows in the BAM binning scheme
+LEAF_BINS = range(4681, 37449)
+LEAF_SIZE = 16384
+
+
+def load_hook(spec):
+  if not spec:
+    return None
+  (module, function) = spec.split(':')
+  return getattr(importlib.import_module(module), function)
+
+
+'''
+Run a hook, reporting rather than raising errors. The download is good whether
+or not the hook works.
+'''
+def run_hook(hook, path, index_path, output_path):
+  try:
+    hook(path, index_path, output_path)
+    return True
+  except Exception as ex:
+    print(f'{path}: post download hook {hook.__name__} failed: {ex}')
+    return False
+
+
+def _write(path, text):
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    f.write(text)
+  os.replace(tmp, path)
+
+
+'''
+The header text and (name, length) of each reference from a BAM. Only the
+first BGZF blocks are decompressed.
+'''
+def read_bam_header(path):
+  with gzip.open(path, 'rb') as f:
+    if f.read(4) != b'BAM\1':
+      raise ValueError(f'{path} is not a BAM file')
+    (l_text,) = struct.unpack('<i', f.read(4))
+    text = f.read(l_text).rstrip(b'\0').decode()
+    (n_ref,) = struct.unpack('<i', f.read(4))
+    refs = []
+    for _ in range(n_ref):
+      (l_name,) = struct.unpack('<i', f.read(4))
+      name = f.read(l_name).rstrip(b'\0').decode()
+      (l_ref,) = struct.unpack('<i', f.read(4))
+      refs.append((name, l_ref))
+  return (text, refs)
+
+
+'''
+For each reference in a BAI: mapped reads, unmapped reads placed there and how
+many 16kb windows have reads starting in them.
+'''
+def read_bai_counts(path):
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data[:4] != b'BAI\1':
+    raise ValueError(f'{path} is not a BAI file')
+  (n_ref,) = struct.unpack_from('<i', data, 4)
+  pos = 8
+  counts = []
+  for _ in range(n_ref):
+    mapped = unmapped = windows = 0
+    (n_bin,) = struct.unpack_from('<i', data, pos)
+    pos += 4
+    for _ in range(n_bin):
+      (bin, n_chunk) = struct.unpack_from('<Ii', data, pos)
+      pos += 8
+      if bin == BAI_PSEUDO_BIN:
+        (_, _, mapped, unmapped) = struct.unpack_from('<QQQQ', data, pos)
+      elif bin in LEAF_BINS:
+        windows += 1
+      pos += 16 * n_chunk
+    (n_intv,) = struct.unpack_from('<i', data, pos)
+    pos += 4 + 8 * n_intv
+    counts.append((mapped, unmapped, windows))
+  return counts
+
+
+'''
+Writes output_path.header.sam, the BAM header, and, given the index,
+output_path.summary.tsv with the read counts and a rough idea of the coverage
+of each reference.
+'''
+def bam_summary(path, index_path, output_path):
+  if not path.endswith('.bam'):
+    return
+  (text, refs) = read_bam_header(path)
+  _write(output_path + '.header.sam', text)
+
+  if not index_path or not index_path.endswith('.bai'):
+    return
+  lines = ['reference\tlength\tmapped\tunmapped\treads_per_mb\tfraction_16kb_windows_with_reads']
+  for ((name, length), (mapped, unmapped, windows)) in zip(refs, read_bai_counts(index_path)):
+    reads_per_mb = mapped / length * 1e6 if length else 0.0
+    fraction = windows / ((length + LEAF_SIZE - 1) // LEAF_SIZE) if length else 0.0
+    lines.append(f'{name}\t{length}\t{mapped}\t{unmapped}\t{reads_per_mb:.1f}\t{fraction:.3f}')
+  _write(output_path + '.summary.tsv', '\n'.join(lines) + '\n')
+  print(f'{output_path}: wrote header and summary')
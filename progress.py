@@ -0,0 +1,192 @@
+'''
+Aggregated progress reporting for downloads running in a multiprocessing pool.
+
+Each pool worker owns one slot in a set of shared memory counters. The per-chunk
+callback only bumps the counters for its own slot, so there are no locks or queues
+on the hot path. A single renderer thread in the parent process samples the counters
+at a fixed rate and draws the aggregate throughput, ETA, job counts and a bar for
+each active file.
+'''
+
+import multiprocessing as mp
+import threading
+import time
+import sys
+from collections import deque
+
+IDLE = -1
+
+# Worker side view of the board, installed by install_worker() in each pool process
+_slots = None
+_slot = None
+
+
+'''
+Called once in each pool worker (as the Pool initializer) to claim a slot.
+'''
+def install_worker(slots, next_slot):
+  global _slots, _slot
+  with next_slot.get_lock():
+    _slot = next_slot.value % len(slots['file'])
+    next_slot.value += 1
+  _slots = slots
+
+
+'''
+Progress callback used inside a worker. Compatible with the GDCFileDownloader
+progress_callback protocol.
+'''
+class SlotProgressMeter:
+  def __call__(self, file_name, total_length, chunk_length, resumed=False, dropped=False, **kwargs):
+    _slots['total'][_slot] = total_length
+    if dropped:
+      _slots['errors'][_slot] += 1
+    elif resumed:
+      # A (re)start: chunk_length is what is already on disk. Bank what the
+      # previous attempt transferred and restart the count from there.
+      _slots['transferred'][_slot] += _slots['done'][_slot] - _slots['resumed'][_slot]
+      _slots['done'][_slot] = chunk_length
+      _slots['resumed'][_slot] = chunk_length
+    else:
+      _slots['done'][_slot] += chunk_length
+
+
+'''
+Wraps a downloader so its progress is published to the worker's slot.
+'''
+class TrackedDownload:
+  def __init__(self, file_idx, downloader):
+    self.file_idx = file_idx
+    self.downloader = downloader
+
+  def __call__(self, *args, **kwargs):
+    _slots['done'][_slot] = 0
+    _slots['resumed'][_slot] = 0
+    _slots['total'][_slot] = self.downloader.expected_file_size or 0
+    _slots['file'][_slot] = self.file_idx
+
+    self.downloader.progress_callback = SlotProgressMeter()
+    ok = self.downloader()
+
+    if ok:
+      _slots['finished'][_slot] += 1
+    else:
+      _slots['failed'][_slot] += 1
+    _slots['transferred'][_slot] += _slots['done'][_slot] - _slots['resumed'][_slot]
+    _slots['completed'][_slot] += max(_slots['total'][_slot], _slots['done'][_slot])
+    _slots['file'][_slot] = IDLE
+    return ok
+
+
+'''
+The parent side of the progress system. Create it before the Pool and pass
+pool_kwargs() to the Pool constructor so the workers inherit the shared counters.
+'''
+class ProgressBoard:
+  def __init__(self, num_workers, refresh_interval=1.0, rate_window=10.0):
+    self.slots = {
+      'file': mp.RawArray('q', [IDLE] * num_workers),
+      'done': mp.RawArray('q', num_workers),
+      'total': mp.RawArray('q', num_workers),
+      'resumed': mp.RawArray('q', num_workers),
+      'transferred': mp.RawArray('q', num_workers),
+      'completed': mp.RawArray('q', num_workers),
+      'finished': mp.RawArray('q', num_workers),
+      'failed': mp.RawArray('q', num_workers),
+      'errors': mp.RawArray('q', num_workers),
+    }
+    self.next_slot = mp.Value('i', 0)
+    self.file_names = []
+    self.planned_bytes = 0
+    self.refresh_interval = refresh_interval
+    self.rate_window = rate_window
+    self.samples = deque()
+    self.stopped = threading.Event()
+    self.thread = None
+    self.term = self._terminal() if sys.stdout.isatty() else None
+
+  @staticmethod
+  def _terminal():
+    # Only needed when drawing to a terminal, so batch jobs don't import it
+    try:
+      from blessings import Terminal
+    except ModuleNotFoundError:
+      return None
+    return Terminal()
+
+  def pool_kwargs(self):
+    return {'initializer': install_worker, 'initargs': (self.slots, self.next_slot)}
+
+  def track(self, file_name, downloader):
+    self.file_names.append(file_name)
+    self.planned_bytes += downloader.expected_file_size or 0
+    return TrackedDownload(len(self.file_names) - 1, downloader)
+
+  def start(self):
+    if self.term:
+      print(self.term.clear, end='')
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread:
+      self.thread.join()
+    self.render()
+
+  def active(self):
+    return [i for i, f in enumerate(self.slots['file']) if f != IDLE]
+
+  def transferred_bytes(self):
+    s = self.slots
+    return sum(s['transferred']) + sum(s['done'][i] - s['resumed'][i] for i in self.active())
+
+  def errors(self):
+    return sum(self.slots['errors'])
+
+  def _run(self):
+    while not self.stopped.wait(self.refresh_interval):
+      self.render()
+
+  def _rate(self, now, transferred):
+    self.samples.append((now, transferred))
+    while len(self.samples) > 2 and now - self.samples[0][0] > self.rate_window:
+      self.samples.popleft()
+    t0, b0 = self.samples[0]
+    if now <= t0:
+      return 0.0
+    return (transferred - b0) / (now - t0)
+
+  def render(self):
+    s = self.slots
+    active = self.active()
+    finished = sum(s['finished'])
+    failed = sum(s['failed'])
+    queued = len(self.file_names) - finished - failed - len(active)
+
+    rate = self._rate(time.time(), self.transferred_bytes())
+    in_flight = sum(max(s['total'][i], s['done'][i]) for i in active)
+    remaining = max(0, self.planned_bytes - sum(s['completed']) - in_flight) + \
+                sum(max(0, s['total'][i] - s['done'][i]) for i in active)
+    if rate > 0:
+      secs = int(remaining / rate)
+      eta = f'{secs // 3600:02d}:{secs // 60 % 60:02d}:{secs % 60:02d}'
+    else:
+      eta = '--:--:--'
+
+    summary = f'{rate / 1e6:8.2f} MB/s  ETA {eta}  active: {len(active)}  queued: {queued}  ' + \
+              f'done: {finished}  failed: {failed}'
+
+    if not self.term:
+      print(summary, flush=True)
+      return
+
+    lines = [summary, '']
+    width = max(10, self.term.width - 60)
+    for i in active[:max(0, self.term.height - 3)]:
+      name = self.file_names[s['file'][i]][-40:]
+      done, total = s['done'][i], s['total'][i]
+      frac = done / total if total else 0.0
+      bar = '#' * int(frac * width)
+      lines.append(f'{name:40} [{bar:{width}}] {100 * frac:5.1f}%')
+    print(self.term.move(0, 0) + self.term.clear_eos + '\n'.join(lines), flush=True)
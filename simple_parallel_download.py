@@ -1,29 +1,9 @@
-import multiprocessing as mp
 from helpers import GDCIterator, GDCFileAuthProvider, GDCFileDownloader
-try:
-  from blessings import Terminal
-  terminal_control = True
-  print(Terminal().clear)
-except ModuleNotFoundError:
-  terminal_control = False
+from progress import ProgressBoard
+from concurrency import AdaptivePool
 
-N_THREADS = 5
-
-def process_file(file, q):
-  fn = file['file_name']
-  f_id = file['file_id']
-
-  dl_bytes = 0
-  def progress(t, c):
-    nonlocal dl_bytes
-    dl_bytes = dl_bytes + c
-    print(f'downloading {fn}: {dl_bytes}/{t}', end='\r')
-
-  dl = GDCFileDownloader(f_id, fn, auth_provider, progress)
-  dl()
-  print('')
-
-  return dl
+# Upper limit on concurrent downloads, the number actually used adapts to the throughput
+MAX_THREADS = 16
 
 case_filters = {
   'op': '=',
@@ -59,47 +39,33 @@ file_filters = {
   ]
 }
 
-class SimpleProgressMeter:
-  def __init__(self, file_name, file_cnt):
-    self.dl_bytes = 0
-    self.file_name = file_name
-    self.file_cnt = file_cnt
-    self.term = None
-
-  def __call__(self, total, chunk):
-    if not terminal_control:
-      return
-
-    if self.term is None:
-      # Note: the terminal object needs to be created in the download thread otherwise it fails
-      self.term = Terminal()
 
-    self.dl_bytes = self.dl_bytes + chunk
-    with self.term.location(0, self.file_cnt):
-      print(f'downloading {self.file_name}: {self.dl_bytes}/{total}')
+def queued_downloads(auth_provider):
+  for case in GDCIterator('cases', case_filters, fields=['submitter_id']):
+    file_filters['content'][0]['content']['value'] = case['submitter_id']
 
-p = mp.Pool(N_THREADS)
-auth_provider = GDCFileAuthProvider()
+    for fl in GDCIterator('files', file_filters, fields=['file_id', 'file_name', 'file_size', 'md5sum']):
+      file_name = fl['file_name']
+      file_id = fl['file_id']
 
-file_cnt = 0
-downloads = []
-for case in GDCIterator('cases', case_filters):
-  file_filters['content'][0]['content']['value'] = case['submitter_id']
+      download = GDCFileDownloader(file_id, file_name,
+                                   expected_file_size=fl.get('file_size'),
+                                   md5sum=fl.get('md5sum'),
+                                   auth_provider=auth_provider)
+      yield file_name, download
 
-  for fl in GDCIterator('files', file_filters):
-    file_name = fl['file_name']
-    file_id = fl['file_id']
 
-    pm = SimpleProgressMeter(file_name, file_cnt)
-    download = GDCFileDownloader(file_id, file_name, auth_provider, pm)
+def main():
+  board = ProgressBoard(MAX_THREADS)
+  p = AdaptivePool(MAX_THREADS, board=board)
+  auth_provider = GDCFileAuthProvider()
 
-    dh = p.apply_async(download)
-    downloads.append(dh)
+  board.start()
+  results = p.run(queued_downloads(auth_provider))
+  board.stop()
+  print(f'{len(results)} files processed, {results.count(False)} failed.')
+  print('Done.')
 
-    file_cnt = file_cnt+1
 
-print(f'{file_cnt} files queued for download.')
-for dl in downloads:
-  dl.get()
-p.join()
-print('Done.')
+if __name__ == '__main__':
+  main()
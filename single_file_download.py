@@ -1,8 +1,25 @@
-from helpers import GDCFileAuthProvider, GDCFileDownloader
+from helpers import GDCFileAuthProvider, GDCFileDownloader, GDCAuthError, FileCache
+from helpers import GDCSliceDownloader, read_regions, slice_record
+from concurrency import AdaptivePool
+from post_download import load_hook, run_hook
 from argparse import ArgumentParser
-import multiprocessing as mp
+import os
+import shutil
 import sys
 
+# Space to leave free on the download filesystem, on top of the files themselves
+FREE_SPACE_RESERVE = 1024 * 1024 * 1024
+
+# A site wide download cache (see helpers/cache.py) and its size limit in GB
+CACHE_DIR = os.environ.get('GDC_CACHE_DIR')
+CACHE_QUOTA_GB = os.environ.get('GDC_CACHE_QUOTA_GB')
+
+# A post download hook (see post_download.py), e.g. post_download:bam_summary
+POST_DOWNLOAD = os.environ.get('GDC_POST_DOWNLOAD')
+
+# Download only these regions of each BAM: a BED file or e.g. chr7:55019017-55211628,chr12
+REGIONS = os.environ.get('GDC_REGIONS')
+
 def build_parser():
   parser = ArgumentParser()
   parser.add_argument('--output-paths',
@@ -21,15 +38,171 @@ def build_parser():
                       dest='sizes',
                       help='expected file sizes',
                       required=False)
+  parser.add_argument('--index-files',
+                      dest='index_files',
+                      help='comma separated file_id:md5sum:size:extension of the index for each file, or none for a file without one',
+                      default=None,
+                      required=False)
+  parser.add_argument('--post-download',
+                      dest='post_download',
+                      help='module:function to run on each file once downloaded, e.g. post_download:bam_summary',
+                      default=POST_DOWNLOAD,
+                      required=False)
+  parser.add_argument('--regions',
+                      dest='regions',
+                      help='A BED file or comma separated regions. Only these regions of each BAM are downloaded, '
+                           'through the GDC slicing endpoint',
+                      default=REGIONS,
+                      required=False)
+  parser.add_argument('--staging-dir',
+                      dest='staging_dir',
+                      help='Download to this (node local) directory instead of the output paths',
+                      default=None,
+                      required=False)
+  parser.add_argument('--paths-file',
+                      dest='paths_file',
+                      help='Write the comma separated paths the files were downloaded to into this file',
+                      default=None,
+                      required=False)
+  parser.add_argument('--max-parallel',
+                      dest='max_parallel',
+                      help='Upper limit on concurrent downloads. The number actually used adapts to the throughput.',
+                      type=int,
+                      default=None,
+                      required=False)
+  parser.add_argument('--publish',
+                      dest='publish',
+                      help='Copy verified files from the staging directory to the output paths, then exit',
+                      action='store_true',
+                      default=False,
+                      required=False)
   return parser
 
 
+def sum_file(path):
+  return os.path.splitext(path)[0] + '.md5'
+
+
+'''
+With regions, slices have no md5sum from GDC. They are checked against the
+record of what was sliced instead.
+'''
+def is_verified(path, md5sum, regions=None):
+  if regions:
+    return slice_record(path, regions) is not None
+  if md5sum is None or not os.path.exists(path) or not os.path.exists(sum_file(path)):
+    return False
+  with open(sum_file(path), 'r') as f:
+    return f.read().strip() == md5sum
+
+
+def partial_size(path):
+  return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+'''
+Append the index files given by --index-files to the download lists. Each index
+is kept next to its file with its extension added, e.g. x.bam.bai. Returns the
+index output path for each file, or None.
+'''
+def add_index_files(index_files, output_paths, file_ids, md5sums, sizes):
+  indexes = []
+  for (spec, output_path) in zip(index_files.split(','), list(output_paths)):
+    # - from jobs submitted before none was used
+    if spec.strip() in ('none', '-'):
+      indexes.append(None)
+      continue
+    (file_id, md5sum, size, extension) = spec.strip().split(':')
+    output_paths.append(output_path + extension)
+    file_ids.append(file_id)
+    md5sums.append(md5sum)
+    sizes.append(int(size))
+    indexes.append(output_path + extension)
+  return indexes
+
+
+'''
+True if the directory has room for needed bytes plus FREE_SPACE_RESERVE.
+'''
+def has_room(directory, needed):
+  free = shutil.disk_usage(directory).free
+  if free < needed + FREE_SPACE_RESERVE:
+    print(f'{directory}: {needed} bytes needed but only {free} free')
+    return False
+  return True
+
+
+'''
+Choose where each file is downloaded to. Files already verified on shared
+storage are used where they are, the rest go to the staging directory if
+they all fit there and the output paths otherwise.
+'''
+def plan_targets(staging_dir, output_paths, md5sums, sizes, regions=None):
+  if not staging_dir:
+    return list(output_paths)
+
+  os.makedirs(staging_dir, exist_ok=True)
+  targets = []
+  needed = 0
+  for (output_path, md5sum, size) in zip(output_paths, md5sums, sizes):
+    if is_verified(output_path, md5sum, regions):
+      targets.append(output_path)
+      continue
+    staged = os.path.join(staging_dir, os.path.basename(output_path))
+    needed += max(0, (size or 0) - partial_size(staged))
+    targets.append(staged)
+
+  if not has_room(staging_dir, needed):
+    print('Not enough space to stage, downloading to the output paths')
+    return list(output_paths)
+  return targets
+
+
+'''
+Check every filesystem being downloaded to has room for what is left to fetch.
+Files without a known size are not counted.
+'''
+def check_space(targets, md5sums, sizes, regions=None):
+  needed = {}
+  for (target, md5sum, size) in zip(targets, md5sums, sizes):
+    if is_verified(target, md5sum, regions):
+      continue
+    directory = os.path.dirname(os.path.abspath(target))
+    needed[directory] = needed.get(directory, 0) + max(0, (size or 0) - partial_size(target))
+  return all(has_room(d, n) for d, n in needed.items())
+
+
+'''
+Copy verified downloads from staging to the output paths. The data is copied
+under a temporary name and renamed, and the checksum file is written last, so
+are_files_needed never sees a half copied file as complete.
+'''
+def publish(staging_dir, output_paths, md5sums, regions=None):
+  success = True
+  for (output_path, md5sum) in zip(output_paths, md5sums):
+    staged = os.path.join(staging_dir, os.path.basename(output_path))
+    if os.path.abspath(staged) == os.path.abspath(output_path) or is_verified(output_path, md5sum, regions):
+      continue
+    if not is_verified(staged, md5sum, regions):
+      print(f'{staged}: not verified, not copying to {output_path}')
+      success = False
+      continue
+    print(f'Copying {staged} to {output_path}')
+    part = output_path + '.part'
+    shutil.copyfile(staged, part)
+    os.replace(part, output_path)
+    shutil.copyfile(sum_file(staged), sum_file(output_path))
+    if regions:
+      shutil.copyfile(os.path.splitext(staged)[0] + '.slice', os.path.splitext(output_path)[0] + '.slice')
+  return success
+
+
 def main(argv):
   parser = build_parser()
   options = parser.parse_args(args=argv)
 
-  output_paths = options.output_paths.split(',')
-  file_ids = options.file_ids.split(',')
+  output_paths = [p.strip() for p in options.output_paths.split(',')]
+  file_ids = [f.strip() for f in options.file_ids.split(',')]
 
   md5sums = options.md5sums
   if not md5sums:
@@ -43,23 +216,66 @@ def main(argv):
   else:
     sizes = [int(s) for s in sizes.split(',')]
 
-  p = mp.Pool(len(file_ids))
-  downloads = []
+  # The files asked for, before their index files are added
+  num_files = len(file_ids)
+  indexes = [None] * num_files
+
+  regions = read_regions(options.regions) if options.regions else None
+  if regions:
+    # The GDC size, md5sum and index are for the whole file, not a slice
+    md5sums = [None] * num_files
+    sizes = [None] * num_files
+  elif options.index_files:
+    indexes = add_index_files(options.index_files, output_paths, file_ids, md5sums, sizes)
+
+  if options.publish:
+    if publish(options.staging_dir, output_paths, md5sums, regions):
+      quit(0)
+    quit(1)
+
+  targets = plan_targets(options.staging_dir, output_paths, md5sums, sizes, regions)
+  if not check_space(targets, md5sums, sizes, regions):
+    print('Downloads failed.')
+    quit(1)
+
+  # Check the token before starting, rather than after hours of failed transfers
   auth_provider = GDCFileAuthProvider()
+  try:
+    auth_provider.validate(file_ids[0])
+  except GDCAuthError as ex:
+    print(ex)
+    print('Downloads failed.')
+    quit(1)
 
-  for (output_path, file_id, md5sum, size) in zip(output_paths, file_ids, md5sums, sizes):
-    output_path = output_path.strip()
-    file_id = file_id.strip()
+  cache = None
+  if CACHE_DIR:
+    quota = int(float(CACHE_QUOTA_GB) * 1e9) if CACHE_QUOTA_GB else None
+    try:
+      cache = FileCache(CACHE_DIR, quota)
+    except OSError as ex:
+      print(f'Not using the cache at {CACHE_DIR}: {ex}')
 
-    dl = GDCFileDownloader(file_id, output_path, auth_provider=auth_provider, md5sum=md5sum, expected_file_size=size)
-    h = p.apply_async(dl)
-    downloads.append(h)
+  downloads = []
+  for (output_path, file_id, md5sum, size) in zip(targets, file_ids, md5sums, sizes):
+    if regions:
+      dl = GDCSliceDownloader(file_id, output_path, regions, auth_provider=auth_provider)
+    else:
+      dl = GDCFileDownloader(file_id, output_path, auth_provider=auth_provider, md5sum=md5sum, expected_file_size=size,
+                             cache=cache)
+    downloads.append((output_path, dl))
 
-  success = True
-  for dl in downloads:
-    success = success and dl.get()
+  p = AdaptivePool(min(len(downloads), options.max_parallel or len(downloads)))
+  success = all(p.run(downloads))
 
   if success:
+    hook = load_hook(options.post_download)
+    if hook:
+      where = dict(zip(output_paths, targets))
+      for (output_path, index) in zip(output_paths[:num_files], indexes):
+        run_hook(hook, where[output_path], where.get(index), output_path)
+    if options.paths_file:
+      with open(options.paths_file, 'w') as f:
+        f.write(','.join(targets[:num_files]) + '\n')
     print('Downloads succeeded.')
     quit(0)
   else:
@@ -0,0 +1,48 @@
+import uuid
+
+import batch_download
+import single_file_download
+from helpers import CaseFileSet
+
+
+def _case(tmp_path, with_index):
+  cfs = CaseFileSet(str(tmp_path), str(uuid.uuid4()))
+  for n, has_index in enumerate(with_index):
+    index = (str(uuid.uuid4()), f'{n:032x}', 100 + n, '.bai') if has_index else None
+    cfs.add(str(uuid.uuid4()), f'file{n}.bam', f'{n + 1:032x}', 1000 + n, f'aliquot{n}', index)
+  return cfs
+
+
+def _parse(index_files):
+  # As download-and-process.sh passes it
+  return single_file_download.build_parser().parse_args(
+    ['--output-paths', 'a.bam,b.bam', '--file-ids', 'x,y', '--md5sums', 'm,n', '--sizes', '1,2',
+     f'--index-files={index_files}'])
+
+
+def test_first_file_without_index(tmp_path):
+  cfs = _case(tmp_path, [False, True])
+  arg = batch_download.index_arg(cfs)
+  assert not arg.startswith('-')
+
+  options = _parse(arg)
+  assert options.index_files == arg
+  output_paths, file_ids, md5sums, sizes = ['a.bam', 'b.bam'], ['x', 'y'], ['m', 'n'], [1, 2]
+  indexes = single_file_download.add_index_files(options.index_files, output_paths, file_ids, md5sums, sizes)
+  assert indexes == [None, 'b.bam.bai']
+  assert output_paths == ['a.bam', 'b.bam', 'b.bam.bai']
+  assert sizes == [1, 2, 101]
+
+
+def test_no_indexes(tmp_path):
+  arg = batch_download.index_arg(_case(tmp_path, [False, False]))
+  assert arg == 'none,none'
+  # Also as a separate argument, the way the value was passed before
+  options = single_file_download.build_parser().parse_args(
+    ['--output-paths', 'a.bam,b.bam', '--file-ids', 'x,y', '--index-files', arg])
+  assert single_file_download.add_index_files(options.index_files, ['a', 'b'], [], [], []) == [None, None]
+
+
+def test_old_placeholder():
+  options = _parse('-,-')
+  assert single_file_download.add_index_files(options.index_files, ['a', 'b'], [], [], []) == [None, None]
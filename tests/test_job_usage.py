@@ -0,0 +1,38 @@
+from collections import namedtuple
+
+from batch_download import JobResources, job_failure, parse_usage
+
+JobInfo = namedtuple('JobInfo', 'jobId hasExited exitStatus hasSignal terminatedSignal hasCoreDump wasAborted '
+                                'resourceUsage')
+
+GB = 1024 ** 3
+
+
+def _failed(usage, exit_status=1):
+  return JobInfo('1', True, exit_status, False, '', False, False, usage)
+
+
+def test_pbs_usage():
+  usage = parse_usage({'resources_used.walltime': '72:01:05', 'resources_used.mem': '4194304kb'})
+  assert usage == {'walltime': 72 * 3600 + 65, 'mem': 4 * GB}
+  # A plain PBS number is kB
+  assert parse_usage({'resources_used.mem': '4194304'})['mem'] == 4 * GB
+
+
+def test_sge_usage():
+  usage = parse_usage({'ru_wallclock': '3600.5', 'maxvmem': str(4 * GB), 'mem': '12345.6', 'ru_maxrss': '4194304'})
+  assert usage['walltime'] == 3600.5
+  # maxvmem is bytes, ru_maxrss kB and mem (GB seconds) is ignored
+  assert usage['mem'] == 4 * GB
+  assert parse_usage({'maxvmem': '4.000G'})['mem'] == 4 * GB
+
+
+def test_maxrss_usage():
+  assert parse_usage({'maxrss': '4194304'})['mem'] == 4 * GB
+  assert parse_usage({'maxrss': '4096M'})['mem'] == 4 * GB
+
+
+def test_sge_job_under_its_memory_is_not_a_memory_failure():
+  resources = JobResources(mem_gb=12)
+  assert job_failure(_failed({'ru_wallclock': '60', 'maxvmem': str(4 * GB)}), resources) == 'failed'
+  assert job_failure(_failed({'ru_wallclock': '60', 'maxvmem': str(12 * GB)}), resources) == 'memory'
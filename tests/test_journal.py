@@ -0,0 +1,46 @@
+import batch_download
+from helpers import CaseFileSet
+
+
+def _project(tmp_path, monkeypatch, cases, *args):
+  listed = []
+
+  def cached_file_list(output_dir, project_id, save_query_file, whitelist=None):
+    listed.append(whitelist)
+    return iter([CaseFileSet(output_dir, c) for c in cases])
+
+  monkeypatch.setattr(batch_download, 'cached_file_list', cached_file_list)
+  parser = batch_download.build_parser()
+  options = parser.parse_args(['--gdc-project-id', 'TCGA-AAA', '--output-dir', str(tmp_path),
+                               '--logdir', str(tmp_path)] + list(args))
+  (project,) = batch_download.read_projects(parser, options, str(tmp_path))
+  return (project, listed)
+
+
+def test_in_flight_case_outside_whitelist_is_reattached(tmp_path, monkeypatch):
+  journal_file = str(tmp_path / 'AAA-jobs.journal')
+  batch_download.journal(journal_file, 'case-done', 'done')
+  batch_download.journal(journal_file, 'case-running', 'submitted', job_id='123')
+  (tmp_path / 'whitelist.txt').write_text('case-new\n')
+
+  (project, listed) = _project(tmp_path, monkeypatch, ['case-done', 'case-running', 'case-new', 'case-other'],
+                               '--whitelist', str(tmp_path / 'whitelist.txt'), '--run-anyway')
+  assert project.in_flight == {'case-running'}
+
+  cases = [cfs for (_, cfs) in project.case_files()]
+  # The query asks GDC for the in flight case too
+  assert listed == [{'case-new', 'case-running'}]
+  assert [c.case_id for c in cases] == ['case-running', 'case-new']
+  assert all(project.needs_job(c, None, run_anyway=True) for c in cases)
+
+
+def test_whitelisted_done_case_is_skipped(tmp_path, monkeypatch):
+  journal_file = str(tmp_path / 'AAA-jobs.journal')
+  batch_download.journal(journal_file, 'case-done', 'done')
+  batch_download.journal(journal_file, 'case-failed', 'failed')
+  (tmp_path / 'whitelist.txt').write_text('case-done\ncase-failed\n')
+
+  (project, _) = _project(tmp_path, monkeypatch, ['case-done', 'case-failed'],
+                          '--whitelist', str(tmp_path / 'whitelist.txt'))
+  needed = [c.case_id for (_, c) in project.case_files() if project.needs_job(c, None, run_anyway=True)]
+  assert needed == ['case-failed']
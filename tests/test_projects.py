@@ -0,0 +1,40 @@
+import pytest
+
+import batch_download
+
+
+def _projects(tmp_path, *args):
+  parser = batch_download.build_parser()
+  options = parser.parse_args(['--gdc-project-id', 'TCGA-AAA,TCGA-BBB', '--logdir', str(tmp_path)] + list(args))
+  return batch_download.read_projects(parser, options, str(tmp_path))
+
+
+@pytest.mark.parametrize('option', ['--output-dir', '--save-query-file', '--whitelist', '--failed-file',
+                                    '--journal-file'])
+def test_shared_paths_are_refused(tmp_path, option):
+  args = {'--output-dir': str(tmp_path / '{cancer}')}
+  args[option] = str(tmp_path / 'shared')
+  with pytest.raises(SystemExit):
+    _projects(tmp_path, *[a for kv in args.items() for a in kv])
+
+
+def test_paths_per_project(tmp_path):
+  projects = _projects(tmp_path, '--output-dir', str(tmp_path / '{cancer}'),
+                       '--save-query-file', str(tmp_path / '{project}.pkl'))
+  assert [(p.cancer, p.output_dir, p.save_query_file, p.journal_file) for p in projects] == [
+    ('AAA', str(tmp_path / 'AAA'), str(tmp_path / 'TCGA-AAA.pkl'), str(tmp_path / 'AAA-jobs.journal')),
+    ('BBB', str(tmp_path / 'BBB'), str(tmp_path / 'TCGA-BBB.pkl'), str(tmp_path / 'BBB-jobs.journal')),
+  ]
+
+
+def test_missing_whitelist_skips_that_project(tmp_path):
+  (tmp_path / 'BBB-whitelist.txt').write_text('case-1\ncase-2\n')
+  projects = _projects(tmp_path, '--output-dir', str(tmp_path / '{cancer}'),
+                       '--whitelist', str(tmp_path / '{cancer}-whitelist.txt'))
+  assert [p.project_id for p in projects] == ['TCGA-BBB']
+  assert projects[0].whitelist == {'case-1', 'case-2'}
+
+
+def test_no_whitelists_at_all(tmp_path):
+  with pytest.raises(SystemExit):
+    _projects(tmp_path, '--output-dir', str(tmp_path / '{cancer}'), '--whitelist', str(tmp_path / '{cancer}.txt'))